@@ -18,39 +18,148 @@
 #
 # Source for this program is published at https://github.com/simonhowkins/dcc
 
+import time
+_importStart = time.perf_counter()
+
 import os
 import os.path
 import transaction
 
-from sqlalchemy import engine_from_config
+from sqlalchemy import engine_from_config, event
+from sqlalchemy.pool import QueuePool
 from sqlalchemy.orm import scoped_session, sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
 from zope.sqlalchemy import ZopeTransactionExtension
 
 from pyramid.config import Configurator
 from pyramid.response import Response
+from pyramid.settings import asbool
 
 import app.controllers
 from app.models import Base
 from app.models.engine import Engine
+from app.models.roster import roster
+from app.models.dcc_channel import DccChannel
+from app.models.dma_buffer import DmaMemory
+from app.models.state_journal import StateJournal
 import app.services.dcclib
+from app.services import command_trace, metrics
+from app.services.track_simulator import TrackSimulator
+
+# SQLite pragmas that can be set from the settings, eg sqlite.journal_mode = wal
+SQLITE_PRAGMAS = ["journal_mode", "synchronous", "busy_timeout", "cache_size"]
+
+# Create the database engine, tuned according to any sqlite.* settings:
+# * sqlite.<pragma> - set the pragma on each new connection
+# * sqlite.pool_size, sqlite.max_overflow - keep a pool of connections open
+# * sqlite.cached_statements - prepared statements kept per connection
+def make_db_engine(settings):
+    kwargs = {}
+    connectArgs = {}
+    if "sqlite.pool_size" in settings:
+        kwargs["poolclass"] = QueuePool
+        kwargs["pool_size"] = int(settings["sqlite.pool_size"])
+        kwargs["max_overflow"] = int(settings.get("sqlite.max_overflow", 0))
+        # Pooled connections get used by whichever thread takes them next
+        connectArgs["check_same_thread"] = False
+    if "sqlite.cached_statements" in settings:
+        connectArgs["cached_statements"] = int(settings["sqlite.cached_statements"])
+    dbEngine = engine_from_config(settings, 'sqlalchemy.', connect_args=connectArgs, **kwargs)
+
+    pragmas = [(name, settings["sqlite." + name]) for name in SQLITE_PRAGMAS if "sqlite." + name in settings]
+    for (name, value) in pragmas:
+        assert value.replace("-", "").isalnum(), "Bad value for sqlite.%s" % name
+    if pragmas:
+        @event.listens_for(dbEngine, "connect")
+        def setPragmas(connection, record):
+            cursor = connection.cursor()
+            for (name, value) in pragmas:
+                cursor.execute("PRAGMA %s = %s" % (name, value))
+            cursor.close()
+    return dbEngine
+
+# Bring the tables of a database made by an earlier version up to date
+# create_all() only makes missing tables, so add any missing columns - rows
+# that were already there get NULL in them
+def upgrade_db(dbEngine):
+    with dbEngine.begin() as connection:
+        for table in Base.metadata.sorted_tables:
+            existing = {row[1] for row in connection.execute('PRAGMA table_info("%s")' % table.name)}
+            for column in table.columns:
+                if column.name not in existing:
+                    connection.execute('ALTER TABLE "%s" ADD COLUMN "%s" %s' % (table.name, column.name, column.type.compile(dialect=dbEngine.dialect)))
+
+# How long (in seconds) each phase of startup took
+startupTimes = [("imports", time.perf_counter() - _importStart)]
+
+def _startupPhase(name, start):
+    now = time.perf_counter()
+    startupTimes.append((name, now - start))
+    return now
 
 def main(global_config, **settings):
-    app.services.dcclib.unit_test()
+    start = time.perf_counter()
+    if asbool(settings.get("selftest", False)):
+        import app.selftest as selftest
+        selftest.run(selftest.isolatedTests)
+        start = _startupPhase("selftest", start)
+
     # Init hardware (GPIOs, clocks, PWM, DMA)
+    DccChannel.verify = asbool(settings.get("verifyChannels", False))
+    if asbool(settings.get("metrics", False)):
+        metrics.enable()
+    if settings.get("dmaMemoryFile"):
+        chain = DccChannel.run_buffer
+        busAddress = settings.get("dmaMemoryBusAddress")
+        chain.use_memory(DmaMemory(settings["dmaMemoryFile"],
+            DmaMemory.size_for(*[chain.size] * chain.depth),
+            offset=int(settings.get("dmaMemoryOffset", "0"), 0),
+            busAddress=int(busAddress, 0) if busAddress else None))
+    if asbool(settings.get("simulateTrack", False)):
+        # No hardware - play the run buffer on a simulated track instead
+        simulator = TrackSimulator(DccChannel.run_buffer)
+        simulator.track_channels()
+        simulator.start()
+        if metrics.enabled:
+            metrics.collectors.append(simulator.collect)
+    start = _startupPhase("hardware", start)
+
+    # Carry on driving the channels from where they were before the restart
+    if settings.get("journalFile"):
+        journal = StateJournal(settings["journalFile"])
+        DccChannel.restore(journal.restore())
+        DccChannel.journal = journal
+        start = _startupPhase("journal", start)
+    if settings.get("traceFile"):
+        command_trace.recorder = command_trace.CommandTrace(settings["traceFile"])
+        DccChannel.run_buffer.listeners.append(command_trace.recorder.frame)
 
     # Init database
     needToCreateExampleEngine = not os.path.exists(settings['databaseFile'])
-    dbEngine = engine_from_config(settings, 'sqlalchemy.')
-    DBSession = scoped_session(sessionmaker(extension=ZopeTransactionExtension()))
+    dbEngine = make_db_engine(settings)
+    sessionFactory = sessionmaker(extension=ZopeTransactionExtension())
+    roster.watch(sessionFactory)
+    roster.invalidate()
+    DBSession = scoped_session(sessionFactory)
     DBSession.configure(bind=dbEngine)
     Base.metadata.create_all(dbEngine)
+    upgrade_db(dbEngine)
     if needToCreateExampleEngine:
         print("No Engine database found - creating sample Engine...")
         with transaction.manager:
             model = Engine(addr=3, nickname='Boxfresh Loco')
             DBSession.add(model)
             transaction.commit()
+    start = _startupPhase("database", start)
+
+    # Pre-encode the packets for every engine in the shed, in its own speed
+    # step mode and curve - which warms the packet cache with every packet
+    # they'll be driven with
+    with transaction.manager:
+        for e in roster.engines(DBSession):
+            if e.addr:
+                DccChannel(e.addr).set_speed_curve(e.speedSteps, e.speedCurve)
+    start = _startupPhase("packet cache", start)
 
     # Init web app
     settings["DBSession"] = DBSession
@@ -60,4 +169,9 @@ def main(global_config, **settings):
     config.include('pyramid_mako')
     config.include('pyramid_tm')
     controllers.init(config)
-    return config.make_wsgi_app()
+    wsgiApp = config.make_wsgi_app()
+    _startupPhase("web app", start)
+    print("Startup took %.1fms (%s)" % (
+        1000 * sum(seconds for (name, seconds) in startupTimes),
+        ", ".join("%s %.1fms" % (name, 1000 * seconds) for (name, seconds) in startupTimes)))
+    return wsgiApp
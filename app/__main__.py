@@ -0,0 +1,96 @@
+# DCC - Digital Command Control command station
+# Copyright (C) 2018 Simon Howkins
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# Source for this program is published at https://github.com/simonhowkins/dcc
+
+"""Command line tools
+
+python -m app --selftest        Run the unit tests of every module
+python -m app --asgi CONFIG     Serve the command station in ASGI mode (needs uvicorn)
+python -m app --simulate SECS   Drive channels and play the run buffer on a simulated track
+python -m app --estop TRIALS    Measure emergency stop latency on a simulated track
+python -m app --replay TRACE    Replay a command trace, at --speedup times (0 for flat out)
+
+(The command station is usually served with pserve development.ini)"""
+
+import argparse
+import sys
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m app", description="DCC command station tools")
+    parser.add_argument("--selftest", action="store_true", help="run the unit tests of every module")
+    parser.add_argument("--asgi", metavar="CONFIG", help="serve the command station from an asyncio event loop")
+    parser.add_argument("--simulate", metavar="SECONDS", type=float, help="drive channels and play the run buffer on a simulated track")
+    parser.add_argument("--estop", metavar="TRIALS", type=int, help="measure emergency stop latency, from request to track, on a simulated track")
+    parser.add_argument("--replay", metavar="TRACE", help="drive the channels through a recorded command trace")
+    parser.add_argument("--channels", type=int, default=16, help="channels to drive when simulating (default 16)")
+    parser.add_argument("--speedup", type=float, default=1.0, help="track (or trace) time per second when simulating or replaying, 0 for as fast as possible (default 1)")
+    args = parser.parse_args()
+    if args.asgi:
+        import app.asgi
+        app.asgi.serve(args.asgi)
+        return 0
+    if args.simulate:
+        import app.services.track_simulator
+        report = app.services.track_simulator.load_test(args.simulate, args.channels, args.speedup)
+        addresses = report["addresses"].values()
+        latencies = [a["maxLatency"] for a in addresses if a["commands"]]
+        print("Track time %.1fs, %d passes, %d decode errors%s" % (
+            report["trackTime"], report["passes"], report["decodeErrors"],
+            " (last: %s)" % report["lastError"] if report["lastError"] else ""))
+        print("%-8s %10s %10s %9s %12s %12s" % ("addr", "refreshes", "rate (Hz)", "max gap", "mean latency", "max latency"))
+        for (addr, a) in report["addresses"].items():
+            latency = "%10.0fms %10.0fms" % (1000 * a["meanLatency"], 1000 * a["maxLatency"]) if a["commands"] else "%12s %12s" % ("-", "-")
+            print("%-8s %10d %10.1f %8.0fms %s" % (addr, a["refreshes"], a["refreshRate"], 1000 * a["maxGap"], latency))
+        if latencies:
+            print("Worst command latency %.0fms (%d commands superseded before reaching the track)" % (1000 * max(latencies), report["superseded"]))
+        return 1 if report["decodeErrors"] else 0
+    if args.estop:
+        import app.services.track_simulator
+        from pyramid.request import Request
+        from app.controllers.cab import CabController
+        from app.models.dcc_channel import DccChannel
+        # Each stop is made as the web app would make it
+        stop = lambda: CabController(Request.blank("/cab/stop", POST={})).stop()
+        report = app.services.track_simulator.stop_test(args.estop, args.channels, stop)
+        stops = report["addresses"].get(0)
+        published = DccChannel.stop_status()
+        print("%d stops with %d channels running, %d decode errors" % (args.estop, args.channels, report["decodeErrors"]))
+        print("Request to run buffer: worst %.1fms, last %.1fms" % (1000 * published["maxLatency"], 1000 * published["lastLatency"]))
+        if stops and stops["commands"]:
+            print("Request to track:      worst %.1fms, mean %.1fms (%d stops seen)" % (1000 * stops["maxLatency"], 1000 * stops["meanLatency"], stops["commands"]))
+        print("Bound: %.1fms (two frames of a full run buffer)" % (1000 * DccChannel.packets.max_latency()))
+        return 1 if report["decodeErrors"] or not stops or stops["commands"] < args.estop else 0
+    if args.replay:
+        import app.services.command_trace
+        report = app.services.command_trace.replay(args.replay, args.speedup or None)
+        print("Replayed %.1fs of trace in %.2fs: %d sessions, %d commands, %d shed changes, %d frames" % (
+            report["traceTime"], report["elapsed"], report["sessions"], report["commands"], report["shedChanges"], report["frames"]))
+        for (when, type, error) in report["errors"]:
+            print("%10.4fs %s: %s" % (when, type, error))
+        if report["mismatches"]:
+            print("Final speeds differ from the recording for: %s" % ", ".join(map(str, report["mismatches"])))
+        return 1 if report["errors"] or report["mismatches"] else 0
+    if not args.selftest:
+        parser.print_help()
+        return 2
+    import app.selftest
+    for (name, seconds) in app.selftest.run():
+        print("%-16s passed in %6.1fms" % (name, seconds * 1000))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,368 @@
+# DCC - Digital Command Control command station
+# Copyright (C) 2018 Simon Howkins
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# Source for this program is published at https://github.com/simonhowkins/dcc
+
+"""ASGI server mode
+
+Serves the command station from an asyncio event loop, so open cabs don't
+each need a server thread:
+* /cab/update and /cab/update_many run CabController on the loop itself,
+  as they only touch channel state - if a channel write is in progress on
+  another thread, they go to the thread pool instead of waiting for it
+* /cab/stop makes the emergency stop on the loop, straight away, and only
+  waits for it to reach the run buffer in a thread
+* /cab/stream is an async status stream, woken by channel changes, so
+  hundreds of them cost no threads at all
+* Everything else (the shed, driving an engine, static files) is the
+  ordinary Pyramid app, run in a thread pool along with its DB access
+
+Serve with: python -m app --asgi development.ini (needs uvicorn), or any
+ASGI server, using app.asgi:create_app as an application factory"""
+
+import asyncio
+import io
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from pyramid.httpexceptions import HTTPException
+from pyramid.request import Request
+
+from app.controllers.cab import CabController, too_many_addresses
+from app.models.dcc_channel import DccChannel
+from app.models.packet_scheduler import TooManyAddresses
+from app.services import command_trace, metrics
+
+class AsgiApp(object):
+    # Class constants:
+    # Cab actions that are run on the event loop, by path
+    LOOP_ACTIONS = {"/cab/update": "update", "/cab/update_many": "update_many", "/cab/function": "function"}
+
+    def __init__(self, wsgiApp, threads=8, streamMaxRate=5, keepAlive=15):
+        # Instance attributes:
+        self.wsgiApp = wsgiApp
+        self.executor = ThreadPoolExecutor(threads, thread_name_prefix="asgi-pool")
+        self.minInterval = 1 / streamMaxRate
+        self.keepAlive = keepAlive
+        self.loop = None
+        # The asyncio.Events of the streams watching each address
+        # Only changed on the loop; read by the listener from any thread
+        self._watchers = {}
+        DccChannel.listeners.append(self._channelChanged)
+
+    async def __call__(self, scope, receive, send):
+        if self.loop is None:
+            self.loop = asyncio.get_running_loop()
+        if scope["type"] == "lifespan":
+            await self._lifespan(receive, send)
+        elif scope["type"] == "http":
+            if scope["path"] == "/cab/stream":
+                await self._stream(scope, receive, send)
+            else:
+                body = await self._readBody(receive)
+                environ = self._environ(scope, body)
+                action = AsgiApp.LOOP_ACTIONS.get(scope["path"])
+                if scope["path"] == "/cab/stop" and scope["method"] == "POST":
+                    response = await self._emergencyStop(environ)
+                elif action and scope["method"] == "POST":
+                    response = await self._cabAction(environ, action)
+                else:
+                    response = await self.loop.run_in_executor(self.executor, self._callWsgi, environ)
+                await self._respond(send, *response)
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                self.close()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    def close(self):
+        if self._channelChanged in DccChannel.listeners:
+            DccChannel.listeners.remove(self._channelChanged)
+        self.executor.shutdown(wait=False)
+
+    # Run a CabController action on the loop, unless that would mean
+    # waiting for the channel lock
+    async def _cabAction(self, environ, action):
+        if DccChannel.lock.acquire(blocking=False):
+            try:
+                return self._callCab(environ, action)
+            finally:
+                DccChannel.lock.release()
+        return await self.loop.run_in_executor(self.executor, self._callCab, environ, action)
+
+    # Nothing has priority over an emergency stop - it waits for the channel
+    # lock on the loop rather than queue for a thread, and waiting for it to
+    # be published doesn't use one of the pool's threads either
+    async def _emergencyStop(self, environ):
+        start = time.perf_counter()
+        command_trace.record("stop")
+        DccChannel.emergency_stop(wait=False)
+        latency = await self.loop.run_in_executor(None, DccChannel.wait_for_stop, start)
+        return self._callCab(environ, "stop", "_stopped", latency, start=start)
+
+    # Call a CabController method, and respond as the Pyramid app would -
+    # bad input is the controller's HTTPBadRequest, and anything unexpected
+    # is raised, for the server to make a 500 of
+    # The request is timed as the metrics tween would time it, by action
+    def _callCab(self, environ, action, method=None, *args, start=None):
+        start = start or time.perf_counter()
+        failed = True
+        try:
+            try:
+                result = getattr(CabController(Request(environ)), method or action)(*args)
+                response = (200, [("Content-Type", "application/json")], json.dumps(result).encode())
+            except HTTPException as e:
+                response = self._callWsgi(environ, e)
+            except TooManyAddresses as e:
+                response = self._callWsgi(environ, too_many_addresses(e, None))
+            failed = False
+            return response
+        finally:
+            metrics.observe_request("cab." + action, time.perf_counter() - start, failed)
+
+    # The status stream of /cab/stream, as server-sent events - the same
+    # events as CabController.stream, without holding a thread
+    async def _stream(self, scope, receive, send):
+        environ = self._environ(scope, b"")
+        try:
+            channel = CabController(Request(environ))._channel()
+        except HTTPException as e:
+            await self._respond(send, *self._callWsgi(environ, e))
+            return
+        await send({"type": "http.response.start", "status": 200, "headers": [
+            (b"content-type", b"text/event-stream"), (b"cache-control", b"no-cache")]})
+        events = asyncio.ensure_future(self._events(channel, send))
+        disconnect = asyncio.ensure_future(self._untilDisconnected(receive))
+        try:
+            await asyncio.wait([events, disconnect], return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            events.cancel()
+            disconnect.cancel()
+            # Let them finish, so the stream stops watching its channel
+            (result, disconnected) = await asyncio.gather(events, disconnect, return_exceptions=True)
+        if isinstance(result, Exception):
+            raise result
+
+    async def _events(self, channel, send):
+        changed = asyncio.Event()
+        self._watchers.setdefault(channel.addr, set()).add(changed)
+        try:
+            version = None
+            while True:
+                if channel.version == version:
+                    try:
+                        await asyncio.wait_for(changed.wait(), self.keepAlive)
+                    except asyncio.TimeoutError:
+                        await send({"type": "http.response.body", "body": b": keep-alive\n\n", "more_body": True})
+                        continue
+                changed.clear()
+                version = channel.version
+                data = "data: %s\n\n" % json.dumps(CabController(None)._status(channel))
+                await send({"type": "http.response.body", "body": data.encode(), "more_body": True})
+                # Let any further changes accumulate, so they're sent as one event
+                await asyncio.sleep(self.minInterval)
+        finally:
+            watchers = self._watchers[channel.addr]
+            watchers.discard(changed)
+            if not watchers:
+                del self._watchers[channel.addr]
+
+    async def _untilDisconnected(self, receive):
+        while (await receive())["type"] != "http.disconnect":
+            pass
+
+    # DccChannel listener - called on whichever thread changed the channel
+    def _channelChanged(self, addr):
+        if addr in self._watchers:
+            self.loop.call_soon_threadsafe(self._wake, addr)
+
+    def _wake(self, addr):
+        for changed in self._watchers.get(addr, ()):
+            changed.set()
+
+    async def _readBody(self, receive):
+        chunks = []
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                break
+            chunks.append(message.get("body", b""))
+            if not message.get("more_body", False):
+                break
+        return b"".join(chunks)
+
+    # A WSGI environ for an ASGI http request
+    def _environ(self, scope, body):
+        (serverName, serverPort) = scope.get("server") or ("localhost", 80)
+        environ = {
+            "REQUEST_METHOD": scope["method"],
+            "SCRIPT_NAME": scope.get("root_path", ""),
+            "PATH_INFO": scope["path"],
+            "QUERY_STRING": scope["query_string"].decode("latin-1"),
+            "SERVER_NAME": serverName,
+            "SERVER_PORT": str(serverPort),
+            "SERVER_PROTOCOL": "HTTP/%s" % scope.get("http_version", "1.1"),
+            "REMOTE_ADDR": (scope.get("client") or ("", 0))[0],
+            "CONTENT_LENGTH": str(len(body)),
+            "wsgi.version": (1, 0),
+            "wsgi.url_scheme": scope.get("scheme", "http"),
+            "wsgi.input": io.BytesIO(body),
+            "wsgi.errors": sys.stderr,
+            "wsgi.multithread": True,
+            "wsgi.multiprocess": False,
+            "wsgi.run_once": False,
+        }
+        for (name, value) in scope["headers"]:
+            name = name.decode("latin-1").upper().replace("-", "_")
+            value = value.decode("latin-1")
+            if name == "CONTENT_TYPE":
+                environ["CONTENT_TYPE"] = value
+            elif name != "CONTENT_LENGTH":
+                key = "HTTP_" + name
+                environ[key] = environ[key] + "," + value if key in environ else value
+        return environ
+
+    # Run the Pyramid app - called on a pool thread - or another WSGI app,
+    # eg a Pyramid HTTPException
+    def _callWsgi(self, environ, wsgiApp=None):
+        response = {}
+        chunks = []
+        def start_response(status, headers, exc_info=None):
+            response["status"] = int(status.split(" ", 1)[0])
+            response["headers"] = headers
+            return chunks.append
+        result = (self.wsgiApp if wsgiApp is None else wsgiApp)(environ, start_response)
+        try:
+            chunks.extend(result)
+        finally:
+            if hasattr(result, "close"):
+                result.close()
+        return (response["status"], response["headers"], b"".join(chunks))
+
+    async def _respond(self, send, status, headers, body):
+        await send({"type": "http.response.start", "status": status, "headers": [
+            (name.lower().encode("latin-1"), value.encode("latin-1")) for (name, value) in headers]})
+        await send({"type": "http.response.body", "body": body})
+
+    def __repr__(self):
+        return "AsgiApp[streams=%d]" % (sum(map(len, self._watchers.values())))
+
+# ASGI application factory - loads the app from the config file named by
+# the DCC_CONFIG environment variable (default development.ini)
+def create_app(configFile=None):
+    from pyramid.paster import get_app, setup_logging
+    import app.controllers
+    configFile = os.path.abspath(configFile or os.environ.get("DCC_CONFIG", "development.ini"))
+    setup_logging(configFile)
+    wsgiApp = get_app(configFile, "main")
+    settings = app.controllers.settings
+    return AsgiApp(wsgiApp,
+        threads=int(settings.get("asgi.threads", 8)),
+        streamMaxRate=float(settings.get("streamMaxRate", 5)))
+
+# Serve the app with uvicorn, on the address given by listen in the
+# [server:main] section of the config file
+def serve(configFile):
+    import configparser
+    import uvicorn
+    parser = configparser.ConfigParser(interpolation=None)
+    parser.read(configFile)
+    listen = parser.get("server:main", "listen", fallback="localhost:4492")
+    (host, port) = listen.rsplit(":", 1)
+    uvicorn.run(create_app(configFile), host=host, port=int(port), lifespan="on")
+
+def unit_test():
+    print("unit testing AsgiApp")
+
+    def wsgiApp(environ, start_response):
+        start_response("200 OK", [("Content-Type", "text/plain")])
+        return [environ["PATH_INFO"].encode(), environ["wsgi.input"].read()]
+
+    async def request(asgiApp, method, path, query=b"", body=b"", headers=()):
+        messages = [{"type": "http.request", "body": body, "more_body": False}]
+        sent = []
+        async def receive():
+            return messages.pop(0) if messages else {"type": "http.disconnect"}
+        async def send(message):
+            sent.append(message)
+        scope = {"type": "http", "method": method, "path": path, "query_string": query, "headers": list(headers)}
+        await asgiApp(scope, receive, send)
+        return (sent[0]["status"], dict(sent[0]["headers"]), b"".join(m.get("body", b"") for m in sent[1:]))
+
+    async def stream(asgiApp, addr):
+        sent = asyncio.Queue()
+        disconnected = asyncio.Event()
+        async def receive():
+            await disconnected.wait()
+            return {"type": "http.disconnect"}
+        async def send(message):
+            await sent.put(message)
+        scope = {"type": "http", "method": "GET", "path": "/cab/stream", "query_string": b"id=%d" % addr, "headers": []}
+        task = asyncio.ensure_future(asgiApp(scope, receive, send))
+        assert (await sent.get())["status"] == 200
+        first = json.loads((await sent.get())["body"].decode()[len("data: "):])
+        # A change made on another thread wakes the stream up
+        await asyncio.get_running_loop().run_in_executor(None, setattr, DccChannel(addr), "throttle", 0)
+        second = json.loads((await asyncio.wait_for(sent.get(), 5))["body"].decode()[len("data: "):])
+        disconnected.set()
+        await asyncio.wait_for(task, 5)
+        return (first, second)
+
+    async def test():
+        asgiApp = AsgiApp(wsgiApp, threads=2, streamMaxRate=100)
+        try:
+            (status, headers, body) = await request(asgiApp, "POST", "/shed/save", body=b"x=1")
+            assert (status, body) == (200, b"/shed/savex=1")
+            (status, headers, body) = await request(asgiApp, "POST", "/cab/update", b"id=11", b"throttle=3",
+                [(b"content-type", b"application/x-www-form-urlencoded")])
+            assert status == 200 and headers[b"content-type"] == b"application/json"
+            assert json.loads(body.decode())["throttle"] == 3
+            (status, headers, body) = await request(asgiApp, "POST", "/cab/update", b"id=11", b"throttle=99",
+                [(b"content-type", b"application/x-www-form-urlencoded")])
+            assert status == 400 and b"throttle" in body
+            # As is an action run on the loop, which is timed as the tween would
+            metrics.enable()
+            try:
+                (status, headers, body) = await request(asgiApp, "POST", "/cab/function", b"id=11&f=99&on=1")
+                assert status == 400 and b"Bad f" in body
+                assert 'dcc_request_seconds_count{action="cab.function"} 1' in metrics.render()
+            finally:
+                metrics.disable()
+            (status, headers, body) = await request(asgiApp, "GET", "/cab/stream", b"id=x")
+            assert status == 400
+            (status, headers, body) = await request(asgiApp, "POST", "/cab/update_many", body=b'[{"id": 12, "throttle": 2}]',
+                headers=[(b"content-type", b"application/json")])
+            assert json.loads(body.decode())["12"]["throttle"] == 2
+            (first, second) = await stream(asgiApp, 11)
+            assert first["throttle"] == 3 and second["throttle"] == 0
+            assert not asgiApp._watchers
+            (status, headers, body) = await request(asgiApp, "POST", "/cab/stop", b"id=12")
+            assert status == 200 and json.loads(body.decode())["throttle"] == 0
+            assert json.loads(body.decode())["stopLatency"] > 0
+            assert DccChannel.packets.stopped
+        finally:
+            asgiApp.close()
+            DccChannel.update_many([(11, 0, None), (12, 0, None)])
+
+    asyncio.run(test())
@@ -18,11 +18,18 @@
 #
 # Source for this program is published at https://github.com/simonhowkins/dcc
 
+import app.services.metrics
+from app.models.packet_scheduler import TooManyAddresses
+
 settings = None
 
 def init(config):
     config.add_handler('shed', '/shed/{action}', handler="app.controllers.shed.ShedController")
     config.add_handler('cab', '/cab/{action}', handler="app.controllers.cab.CabController")
+    config.add_view("app.controllers.cab.too_many_addresses", context=TooManyAddresses)
+    if app.services.metrics.enabled:
+        config.add_handler('metrics', '/metrics', handler="app.controllers.metrics.MetricsController", action="index")
+        config.add_tween("app.services.metrics.tween_factory")
 
     # Store an accessible reference to the app settings
     global settings
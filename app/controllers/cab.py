@@ -18,48 +18,183 @@
 #
 # Source for this program is published at https://github.com/simonhowkins/dcc
 
+import json
+import threading
+import time
+
+from pyramid.httpexceptions import HTTPBadRequest, HTTPConflict
+from pyramid.response import Response
 from pyramid_handlers import action
 
 import app.controllers
 from app.models.dcc_channel import DccChannel
-from app.models.engine import Engine
+from app.models.roster import roster
+from app.services import command_trace, dcclib
 
 class CabController(object):
+    # Class constants:
+    # Milliseconds a cab over streamMaxCount waits before asking for its
+    # status again
+    POLL_INTERVAL = 1000
+
+    # Class attributes:
+    # Number of status streams open, each holding a server thread
+    streams = 0
+    streamsLock = threading.Lock()
 
     # The lifetime of these objects is a single HTTP request
     def __init__(self, request):
         self.request = request
 
     # User has selected an engine to drive, by engine ID
+    # Selecting any engine in a consist drives the whole consist, via the
+    # lead engine's channel, so one throttle (and one page) drives them all
     @action(renderer="app:templates/cab/drive.mako")
     def drive(self):
-        id = self.request.params.get("id", None)
         dbSession = app.controllers.settings["DBSession"]
-        engine_q = dbSession.query(Engine)
-        e = engine_q.get(id)
-        # Associate the channel with the engine
-        channel = DccChannel(e.addr)
-        channel.engine = e
+        engine = roster.by_id(dbSession, self._int("id", None))
+        if engine is None or not engine.addr:
+            raise HTTPBadRequest("No such engine, or it has no address")
+        engines = roster.consist(dbSession, engine)
+        lead = engines[0]
+        # Associate the channels with the engines
+        # A consist can only go as fast, and speed up and slow down as
+        # quickly, as its slowest engine
+        configuration = (
+            int(lead.addr),
+            min(e.acceleration for e in engines),
+            min(e.braking for e in engines),
+            [(int(e.addr), e.speedSteps, e.speedCurve, e.consistReversed != lead.consistReversed) for e in engines])
+        command_trace.record("drive", *configuration)
+        DccChannel.configure(*configuration)
         return {
-            "addr": e.addr,
-            "maxSpeed": e.maxSpeed,
+            "addr": lead.addr,
+            "maxSpeed": min(e.maxSpeed for e in engines),
+            "maxFunction": dcclib.MAX_FUNCTION,
         }
 
     # User is driving engine
     @action(renderer='json')
     def update(self):
         # Find the channel the user is controlling
-        addr = self.request.params.get("id", None)
-        channel = DccChannel(addr)
+        channel = self._channel()
+        throttle = self._int("throttle", range(29)) if "throttle" in self.request.params else None
+        direction = self._int("direction", [DccChannel.FORWARDS, DccChannel.BACKWARDS]) if "direction" in self.request.params else None
         # Update the channel with the user's request, if applicable
-        if ("throttle" in self.request.params):
-            channel.throttle = int(self.request.params.get("throttle"))
-        if ("direction" in self.request.params):
-            channel.direction = int(self.request.params.get("direction"))
+        if throttle is not None:
+            channel.throttle = throttle
+        if direction is not None:
+            channel.direction = direction
+        command_trace.record("update", channel.addr, throttle, direction)
         # Return the channel status for the ui to display
+        return self._status(channel)
+
+    # User has hit the emergency stop - stops every loco, not just theirs
+    # Returns once the stop is in the run buffer (ie on its way to the track),
+    # with how long that took, and the status of the user's channel, if any
+    @action(renderer='json')
+    def stop(self):
+        command_trace.record("stop")
+        return self._stopped(DccChannel.emergency_stop())
+
+    def _stopped(self, latency):
+        status = self._status(self._channel()) if self.request.params.get("id") else {}
+        status["stopLatency"] = latency
+        return status
+
+    # User is switching a loco function (F0-F28) on or off
+    @action(renderer='json')
+    def function(self):
+        channel = self._channel()
+        (n, on) = (self._int("f", range(dcclib.MAX_FUNCTION + 1)), self.request.params.get("on") in ["1", "true"])
+        channel.set_function(n, on)
+        command_trace.record("function", channel.addr, n, on)
+        return self._status(channel)
+
+    # User is driving several engines at once
+    # Takes a JSON list of {"id": addr, "throttle": n, "direction": d}, where
+    # throttle and direction are optional, and returns the status of every
+    # channel mentioned, keyed by address
+    # Bad input is a 400, and leaves every channel as it was
+    @action(renderer='json')
+    def update_many(self):
+        try:
+            changes = self.request.json_body if self.request.body else []
+            changes = [(
+                change["id"],
+                int(change["throttle"]) if "throttle" in change else None,
+                int(change["direction"]) if "direction" in change else None,
+            ) for change in changes]
+            channels = DccChannel.update_many(changes)
+        except (AssertionError, ValueError, KeyError, TypeError) as e:
+            raise HTTPBadRequest(str(e))
+        for (channel, (addr, throttle, direction)) in zip(channels, changes):
+            command_trace.record("update", channel.addr, throttle, direction)
+        return {str(channel.addr): self._status(channel) for channel in channels}
+
+    # Stream the status of an engine to the ui, as server-sent events
+    # Events are only sent when the channel changes, at most streamMaxRate
+    # times a second, with a comment line every so often to keep the
+    # connection alive
+    # Each stream holds a server thread, so at most streamMaxCount are open
+    # at once - other cabs get their status once, and are told to reconnect
+    # (ie poll) every POLL_INTERVAL
+    @action()
+    def stream(self):
+        channel = self._channel()
+        maxRate = float(app.controllers.settings.get("streamMaxRate", 5))
+        maxCount = int(app.controllers.settings.get("streamMaxCount", 16))
+        response = Response(content_type="text/event-stream", cache_control="no-cache")
+        response.app_iter = self._events(channel, 1 / maxRate, maxCount)
+        return response
+
+    def _events(self, channel, minInterval, maxCount, keepAlive=15):
+        # The count is only taken once the server starts reading the stream,
+        # so it's always given back, when the server closes it
+        with CabController.streamsLock:
+            streaming = CabController.streams < maxCount
+            if streaming:
+                CabController.streams += 1
+        if not streaming:
+            yield ("retry: %d\ndata: %s\n\n" % (CabController.POLL_INTERVAL, json.dumps(self._status(channel)))).encode()
+            return
+        try:
+            version = None
+            while True:
+                latest = channel.wait_for_change(version, keepAlive)
+                if latest == version:
+                    yield b": keep-alive\n\n"
+                    continue
+                version = latest
+                yield ("data: %s\n\n" % json.dumps(self._status(channel))).encode()
+                # Let any further changes accumulate, so they're sent as one event
+                time.sleep(minInterval)
+        finally:
+            with CabController.streamsLock:
+                CabController.streams -= 1
+
+    # The channel the request is for, by address
+    def _channel(self):
+        return DccChannel(self._int("id", range(1, DccChannel.MAX_ADDR + 1)))
+
+    # An integer parameter, which must be one of allowed (if given) - bad
+    # input is a 400, the same whether the action runs under WSGI or ASGI
+    def _int(self, name, allowed):
+        value = self.request.params.get(name)
+        if value is None or not value.lstrip("-").isdigit() or (allowed is not None and int(value) not in allowed):
+            raise HTTPBadRequest("Bad %s: %s" % (name, value))
+        return int(value)
+
+    def _status(self, channel):
+        (throttle, speed, direction, version) = channel.snapshot()
         return {
-            "throttle": channel.throttle,
-            "speed": channel.speed,
-            "direction": channel.direction,
+            "throttle": throttle,
+            "speed": speed,
+            "direction": direction,
+            "functions": channel.functions,
         }
 
+# Every address the refresh stream has room for is in use by a moving loco
+# (or one with functions on) - the user needs to stop one first
+def too_many_addresses(exc, request):
+    return HTTPConflict(str(exc))
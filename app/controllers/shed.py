@@ -24,7 +24,10 @@ from pyramid.response import Response
 from pyramid_handlers import action
 
 import app.controllers
+from app.models.dcc_channel import DccChannel
 from app.models.engine import Engine
+from app.models.roster import roster
+from app.services import command_trace, dcclib
 from pyramid.httpexceptions import *
 
 class ShedController(object):
@@ -36,12 +39,12 @@ class ShedController(object):
         # Remember the request that we're handling, and get a DB handle
         self.request = request
         self.dbSession = app.controllers.settings["DBSession"]
-        self.engine_q = self.dbSession.query(Engine)
 
+    # The roster is rendered from the in-process copy of the Engine table
     @action(renderer="app:templates/shed/index.mako")
     def index(self):
         id = self.request.params.get("id", None)
-        engines = self.engine_q.all()
+        engines = roster.engines(self.dbSession)
         id = int(id) if id != None else engines[0].id if engines else None
         return {
             "engines": engines,
@@ -54,27 +57,71 @@ class ShedController(object):
         maxSpeed = int(self.request.params.getone("maxSpeed"))
         acceleration = self.request.params.getone("acceleration")
         braking = self.request.params.getone("braking")
+        speedSteps = self._speedSteps()
+        speedCurve = self._speedCurve()
+        consist = self.request.params.get("consist", "").strip()
+        consistReversed = "consistReversed" in self.request.params
 
-        e = Engine(nickname, addr, maxSpeed, acceleration, braking)
+        e = Engine(nickname, addr, maxSpeed, acceleration, braking, speedSteps, speedCurve, consist, consistReversed)
         self.dbSession.add(e)
+        command_trace.record("shed", "add", dict(self.request.params))
         self.request.tm.commit()
+        DccChannel.reconsist(roster.consists(self.dbSession))
 
         raise HTTPFound(self.request.route_url("shed", action="index"))
 
+    # If the engine's address changes, the old one stops being refreshed (as
+    # if the engine had been deleted)
     def save(self):
         id = int(self.request.params.getone("id"))
-        e = self.engine_q.get(id)
+        speedSteps = self._speedSteps()
+        speedCurve = self._speedCurve()
+        e = self.dbSession.query(Engine).get(id)
+        oldAddr = int(e.addr or 0)
         e.nickname = self.request.params.getone("nickname")
         e.addr = self.request.params.getone("addr")
         e.maxSpeed = self.request.params.getone("maxSpeed")
         e.acceleration = self.request.params.getone("acceleration")
         e.braking = self.request.params.getone("braking")
+        e.speedSteps = speedSteps
+        e.speedCurve = speedCurve
+        e.consist = self.request.params.get("consist", "").strip()
+        e.consistReversed = "consistReversed" in self.request.params
+        command_trace.record("shed", "save", dict(self.request.params))
+        newAddr = int(e.addr or 0)
         self.request.tm.commit()
+        DccChannel.reconsist(roster.consists(self.dbSession))
+        if oldAddr and oldAddr != newAddr:
+            DccChannel(oldAddr).release()
         raise HTTPFound(self.request.route_url("shed", action="index", _query={"id": id}))
 
+    # The speed step mode the user chose - only those dcclib can encode
+    def _speedSteps(self):
+        speedSteps = self.request.params.get("speedSteps", "28")
+        if not speedSteps.isdigit() or int(speedSteps) not in dcclib.SPEED_STEPS:
+            raise HTTPBadRequest("Speed steps must be one of %s" % ", ".join(map(str, sorted(dcclib.SPEED_STEPS))))
+        return int(speedSteps)
+
+    # The speed curve the user entered, tidied up
+    def _speedCurve(self):
+        try:
+            curve = Engine.parse_curve(self.request.params.get("speedCurve", ""))
+        except ValueError:
+            raise HTTPBadRequest("Speed curve must be a list of percentages, eg 10, 50, 100")
+        return ", ".join(map(str, curve or []))
+
+    # The deleted engine's address stops being refreshed (and the engine
+    # stops, if it was moving), once no consist drives it
     def delete(self):
         id = int(self.request.params.getone("id"))
-        self.dbSession.delete(self.engine_q.get(id))
+        e = self.dbSession.query(Engine).get(id)
+        addr = e.addr
+        self.dbSession.delete(e)
+        command_trace.record("shed", "delete", {"id": id})
         self.request.tm.commit()
+        # No lead drives it from now on
+        DccChannel.reconsist(roster.consists(self.dbSession))
+        if addr:
+            DccChannel(addr).release()
         raise HTTPFound(self.request.route_url("shed", action="index"))
         
@@ -16,69 +16,159 @@
 #
 # Source for this program is published at https://github.com/simonhowkins/dcc
 
-import atexit
-
-from apscheduler.schedulers.background import BackgroundScheduler
+import threading
+import time
+from collections import deque
 
 from app.services import dcclib
-from app.models.dma_buffer import DmaBuffer
+from app.models.refresh_chain import RefreshChain
+from app.models.packet_scheduler import PacketScheduler, TooManyAddresses
 
 """DCC Channel model
 
 Ie an encapsulation of a DCC address and the activity occurring on that
 channel"""
 
-DmaBuffer.unit_test()
-
 sign = lambda x: x and (-1 if x < 0 else 1)
 
+# The state of a single channel, as last written to the run buffer
+# Reads are satisfied from here, so the run buffer never has to be decoded
+#
+# Concurrency: all changes are made with DccChannel.lock held, so there is
+# only ever one writer. Readers don't take the lock - version is a sequence
+# lock, made odd while a change is being made and even again once it's
+# complete, so a reader that needs several fields to agree can tell
+# whether it has seen a half made change and read again. Packets are encoded
+# before the lock is taken, so it's only held while they're published
+class _ChannelState(object):
+    __slots__ = ("throttle", "speed", "forwards", "functions", "speedSteps", "speedTable", "speedPackets", "consist", "accelerationRate", "brakingRate", "rampProgress", "changedAt", "watched", "version")
+
+    def __init__(self):
+        # Incremented at the start and end of every change, so observers can
+        # tell when to look again
+        self.version = 0
+        self.throttle = 0
+        self.speed = 0
+        self.forwards = True
+        # Loco functions, as a bitfield with bit n set if Fn is on
+        self.functions = 0
+        # The speed step mode, and the speed step sent at each speed (ie
+        # throttle notch), as set by set_speed_curve
+        self.speedSteps = 28
+        self.speedTable = DccChannel.LINEAR_SPEEDS
+        # The packet (as DMA bytes) for each speed, by direction then speed,
+        # encoded the first time one's needed
+        self.speedPackets = None
+        # The other channels driven along with this one, as a consist, as
+        # (DccChannel, reversed) - see set_consist
+        self.consist = ()
+        # Speed steps per second when speeding up and slowing down
+        self.accelerationRate = DccChannel.MAX_RAMP_RATE
+        self.brakingRate = DccChannel.MAX_RAMP_RATE
+        # Fraction of a speed step accumulated towards the next one
+        self.rampProgress = 0.0
+        # When (by time.monotonic()) the state last changed
+        self.changedAt = 0.0
+        # Notified when the state changes, once anything waits for it to
+        # (see wait_for_change), so changes wake only their own watchers
+        self.watched = None
+
 class DccChannel(object):
     # Class constants:
     FORWARDS  = 1
     BACKWARDS = -1
 
-    MAX_ADDR = 30
-    assert MAX_ADDR < 127
-    BYTES_PER_CHANNEL = 16
+    # Any short or long DCC address can be used...
+    MAX_ADDR = dcclib.MAX_LONG_ADDR
+    # ...but only this many can be refreshed at once
+    MAX_ACTIVE = 64
+    # Longest packet (a long address speed instruction) in DMA bytes
+    BYTES_PER_CHANNEL = 24
+
+    # Speed steps per second at 100% acceleration or braking
+    MAX_RAMP_RATE = 5
+    # Seconds between ticks of the speed ramping loop
+    RAMP_INTERVAL = 0.05
+
+    # The speed step sent at each speed, unless set_speed_curve says otherwise
+    LINEAR_SPEEDS = dcclib.speed_table(28)
+
+    # Seconds a channel stays in the refresh stream once at rest (stopped,
+    # with no functions on), before it's released to make room for another
+    IDLE_RELEASE = 30
 
     # Class attributes:
-    scheduler = BackgroundScheduler()
-    run_buffer = DmaBuffer(MAX_ADDR * BYTES_PER_CHANNEL, 0)
+    # When set, every read checks the state table against the run buffer
+    verify = False
+    # Held while writing to the run buffer
+    lock = threading.RLock()
+    # Writes made while holding lock are published to the track together
+    # There's room for every active address, plus extra sends of changed packets
+    run_buffer = RefreshChain(2 * MAX_ACTIVE * BYTES_PER_CHANNEL, 0, lock=lock)
+    # Decides which packets go in each frame of the run buffer
+    packets = PacketScheduler(run_buffer)
+    # When set, a StateJournal that every change of state is recorded in
+    journal = None
+    # Functions called (with DccChannel.lock held) with the address of each
+    # channel that changes, eg to wake up an event loop - they must be quick
+    listeners = []
+    # Set while something else, eg a trace replay, runs the speed ramping in
+    # its own time, by calling _adjustSpeeds
+    manualRamping = False
 
     # Phase Two of class definition (by which stage the class object has been created)
     @classmethod
     def __phase2__(clazz):
-        # The singleton status of *all* channels
-        clazz._channels = [{
-            "throttle": 0,
-            "speedAdjusterJob": clazz.scheduler.add_job(clazz._adjustSpeeds, "interval", seconds=1, args=[addr]).pause(),
-        } for addr in range(clazz.MAX_ADDR)]
-        # The array starts at index 0 (duh) which is not a drivable channel,
-        # but it can be safely ignored
-
-        atexit.register(lambda: clazz.scheduler.shutdown(wait=False))
-        clazz.scheduler.start()
-
-    def peek_instruction(buf, fromAddr):
-        offset = fromAddr * DccChannel.BYTES_PER_CHANNEL
-        instBytes = buf[offset:offset + DccChannel.BYTES_PER_CHANNEL]
-        (instAddr, instType, (direction, speed)) = dcclib.decode_instruction(dcclib.decode_stream(dcclib.decode_signal(dcclib.to_binary_array(instBytes))))
+        # The singleton status of all channels, by address
+        # Entries are only created for addresses that are actually used
+        clazz._channels = {}
+
+        # Addresses whose speed doesn't yet match their throttle, which are
+        # the only ones the speed ramping loop looks at
+        # Guarded by the channel lock, like everything else that changes
+        clazz._ramping = set()
+        clazz._rampCondition = threading.Condition(clazz.lock)
+        # How late (in seconds) recent ramping ticks ran, compared with their deadlines
+        clazz.rampTicks = 0
+        clazz.rampLateness = deque(maxlen=100)
+        clazz.rampMaxLateness = 0.0
+        # How long (in seconds) recent emergency stops took to reach the run buffer
+        clazz.stops = 0
+        clazz.stopLatencies = deque(maxlen=100)
+        clazz.stopMaxLatency = 0.0
+
+        threading.Thread(target=clazz._rampLoop, name="speed-ramp", daemon=True).start()
+
+    # Decode the packet being refreshed for an address, if there is one
+    def peek_instruction(packets, fromAddr):
+        instBytes = packets[fromAddr]
+        if instBytes is None:
+            return None
+        (instAddr, instType, (direction, speed)) = dcclib.decode_instruction(dcclib.packet_cache.decode(instBytes))
         assert instAddr == fromAddr
-        assert instType == "SPEED"
+        assert instType in ["SPEED", "SPEED128"]
         assert direction in [True, False]
         assert speed >= 0
-        assert speed <= 28
+        assert speed <= dcclib.SPEED_STEPS[128 if instType == "SPEED128" else 28]
         return (direction, speed)
 
-    def poke_instruction(buf, addr, instruction):
-        offset = addr * DccChannel.BYTES_PER_CHANNEL
-        bytes_to_poke = dcclib.to_bytes(dcclib.round_up(dcclib.to_signal(dcclib.to_stream(instruction))))
+    def poke_instruction(packets, addr, instruction):
+        DccChannel.poke_packet(packets, addr, dcclib.packet_cache.encode(instruction))
+
+    def poke_packet(packets, addr, bytes_to_poke):
         assert len(bytes_to_poke) <= DccChannel.BYTES_PER_CHANNEL
-        buf[offset:offset + len(bytes_to_poke)] = bytes_to_poke
+        packets.update(addr, bytes_to_poke)
+
+    # Function packets are refreshed in the background, less often than speeds
+    def poke_functions(packets, addr, group, bytes_to_poke):
+        packets.update_background((addr, group), bytes_to_poke)
 
     def __init__(self, addr):
         # Instance attributes:
         self._addr = int(addr)
+        assert self._addr > 0
+        assert self._addr <= DccChannel.MAX_ADDR
+        self._state = self._channels.get(self._addr) or self._channels.setdefault(self._addr, _ChannelState())
         assert self._valid()
 
     def __repr__(self):
@@ -87,100 +177,557 @@ class DccChannel(object):
     def _valid(self):
         assert self._addr > 0
         assert self._addr <= DccChannel.MAX_ADDR
-        assert self._channels[self._addr]["throttle"] >= 0
-        assert self._channels[self._addr]["throttle"] <= 28
+        assert self._state.throttle >= 0
+        assert self._state.throttle <= 28
+        return True
+
+    # Check the state table matches what's actually in the run buffer
+    def _verified(self):
+        if DccChannel.verify:
+            # Channels that have never been written to, or have been
+            # released, aren't refreshed at all
+            instruction = DccChannel.peek_instruction(DccChannel.packets, self._addr)
+            if instruction is None:
+                assert self._state.speed == 0, "%s: not in run buffer" % (self)
+            else:
+                (direction, speed) = instruction
+                assert direction == self._state.forwards, "%s: direction %s in run buffer" % (self, direction)
+                assert speed == self._state.speedTable[self._state.speed], "%s: speed step %s in run buffer" % (self, speed)
         return True
 
+    # Decode the whole frame being streamed to the track, and check it
+    # against the state table, eg after recovering from a short circuit
+    @classmethod
+    def verify_run_buffer(clazz):
+        # A frame already being published must finish streaming, then the next one
+        assert clazz.run_buffer.flush(2 * clazz.packets.max_latency()), "Run buffer not published"
+        with clazz.lock:
+            front = clazz.run_buffer.front
+            instructions = dcclib.decode_many(front.frame())
+            # While stopped, the frame is nothing but broadcast emergency stops
+            if clazz.packets.stopped:
+                assert instructions == [(0, "STOP", (1,))] * clazz.packets.URGENT_REPEATS, "Stopped, but %s in run buffer" % (instructions)
+                return True
+            streamed = {addr: (instType, args) for (addr, instType, args) in instructions if instType in ["SPEED", "SPEED128"]}
+            for (addr, state) in clazz._channels.items():
+                if addr in clazz.packets:
+                    expected = ("SPEED128" if state.speedSteps == 128 else "SPEED", (state.forwards, state.speedTable[state.speed]))
+                    assert addr in streamed, "%s: not in run buffer" % (DccChannel(addr))
+                    assert streamed[addr] == expected, "%s: %s in run buffer" % (DccChannel(addr), streamed[addr])
+            # Only some of the function packets are in each frame, but
+            # those that are must be up to date
+            for (addr, instType, args) in instructions:
+                if instType == "FUNCTIONS":
+                    (group, bits) = args
+                    functions = clazz._channels[addr].functions & dcclib.function_group_mask(group)
+                    assert bits == functions, "%s: F%d-F%d are 0x%x in run buffer" % (DccChannel(addr), dcclib.FUNCTION_GROUPS[group][0], dcclib.FUNCTION_GROUPS[group][1], bits)
+        return True
+
+    # Update the state table and the run buffer together, for this channel
+    # and the rest of its consist
+    def _write(self, forwards, speed):
+        with DccChannel.lock:
+            self._writeOne(forwards, speed)
+            for (member, reversed) in self._state.consist:
+                member._writeOne(forwards != reversed, speed)
+
+    # Every packet comes from the channel's table, so speed changes (ramping
+    # ones included) don't build or encode any instructions
+    # Raises TooManyAddresses if the channel isn't in the refresh stream, and
+    # there's no room for it even after releasing every channel at rest
+    def _writeOne(self, forwards, speed):
+        with DccChannel.lock:
+            packet = self._speedPackets()[forwards][speed]
+            if self._addr not in DccChannel.packets:
+                DccChannel._makeRoom(len(packet))
+            DccChannel.poke_packet(DccChannel.packets, self._addr, packet)
+            self._changing()
+            self._state.forwards = forwards
+            self._state.speed = speed
+            self._changed()
+
+    # The channel's table of packets for every speed, encoded the first time
+    # it's needed - without DccChannel.lock, which is only taken to publish
+    # the table, unless the caller already holds it. Callers that are about
+    # to take the lock to write the channel get the table first
+    def _speedPackets(self):
+        state = self._state
+        packets = state.speedPackets
+        while packets is None:
+            (steps, table) = (state.speedSteps, state.speedTable)
+            packets = self._encodeSpeeds(steps, table)
+            with DccChannel.lock:
+                # Unless the speed curve changed meanwhile (then go round again)
+                if (steps, table) == (state.speedSteps, state.speedTable):
+                    state.speedPackets = state.speedPackets or packets
+                packets = state.speedPackets
+        return packets
+
+    # Get the tables of this channel, and the rest of its consist, before
+    # taking the lock to write them
+    def _encodeConsist(self):
+        for channel in self._consistChannels():
+            channel._speedPackets()
+
+    # Build the table of packets for every speed, in both directions
+    def _encodeSpeeds(self, steps, table):
+        return tuple(
+            tuple(dcclib.packet_cache.encode(dcclib.speed_step_instruction(self._addr, forwards, step, steps)) for step in table)
+            for forwards in [False, True])
+
+    # Use a speed step mode (28 or 128) and speed curve (as dcclib.speed_table)
+    # from now on, eg those of the Engine being driven on this channel
+    # The packets for every speed are encoded now, once, before taking the lock
+    def set_speed_curve(self, steps, curve=None):
+        assert self._valid()
+        table = dcclib.speed_table(steps, curve)
+        state = self._state
+        if (steps, table) == (state.speedSteps, state.speedTable) and state.speedPackets:
+            return
+        packets = self._encodeSpeeds(steps, table)
+        with DccChannel.lock:
+            state.speedSteps = steps
+            state.speedTable = table
+            state.speedPackets = packets
+            # If the channel's in use, refresh it the new way
+            if self._addr in DccChannel.packets:
+                self._writeOne(state.forwards, state.speed)
+
+    # Drive other channels along with this one, as a consist: they follow
+    # this channel's speed and direction (the other way if reversed), in the
+    # same change to the run buffer, and only this channel ramps
+    # members is a list of (addr, reversed) - empty to drive this one alone
+    def set_consist(self, members):
+        assert self._valid()
+        consist = tuple((DccChannel(addr), bool(reversed)) for (addr, reversed) in members if int(addr) != self._addr)
+        for channel in [self] + [member for (member, reversed) in consist]:
+            channel._speedPackets()
+        with DccChannel.lock:
+            self._state.consist = consist
+            for (member, reversed) in consist:
+                # Members are only ever written via the lead from now on
+                DccChannel._ramping.discard(member._addr)
+                member._setThrottle(self._state.throttle)
+            if consist:
+                self._write(self._state.forwards, self._state.speed)
+
+    # Stop refreshing this channel, so it takes up no track time, eg once its
+    # engine has been deleted from the shed. Decoders keep the last speed and
+    # functions they heard, so a moving loco is stopped, and its functions
+    # turned off, with urgent packets on the way out
+    # The channel is refreshed again as soon as it's next written to
+    def release(self):
+        assert self._valid()
+        state = self._state
+        while True:
+            # The packets turning off the functions that are on - if any
+            # are switched on meanwhile, they're encoded again
+            functions = state.functions
+            offPackets = self._functionPackets(0, functions)
+            with DccChannel.lock:
+                if state.functions != functions:
+                    continue
+                DccChannel._ramping.discard(self._addr)
+                if state.throttle != 0:
+                    self._setThrottle(0)
+                if state.speed != 0:
+                    self._writeOne(state.forwards, 0)
+                    DccChannel.packets.send_now(DccChannel.packets[self._addr])
+                for group in range(len(dcclib.FUNCTION_GROUPS)):
+                    if group in offPackets:
+                        DccChannel.packets.send_now(offPackets[group])
+                    DccChannel.packets.remove_background((self._addr, group))
+                if state.functions != 0:
+                    self._changing()
+                    state.functions = 0
+                    self._changed()
+                DccChannel.packets.remove(self._addr)
+                # Encoded again if it's ever needed
+                state.speedPackets = None
+                return
+
+    # Make room in the refresh stream for a packet of the given length, for
+    # another address: channels that have been at rest for IDLE_RELEASE are
+    # released, then if that's not enough, the rest of those at rest, the
+    # longest at rest first
+    # Must be called with DccChannel.lock held
+    @classmethod
+    def _makeRoom(clazz, size):
+        resting = sorted((state.changedAt, addr) for (addr, state) in clazz._channels.items()
+            if state.throttle == 0 and state.speed == 0 and state.functions == 0 and addr in clazz.packets)
+        idleSince = time.monotonic() - clazz.IDLE_RELEASE
+        for (changedAt, addr) in resting:
+            if changedAt > idleSince and clazz.packets.has_room(size):
+                break
+            DccChannel(addr).release()
+
+    # Make every consist being driven match consists, eg after the shed has
+    # changed: a lead whose consist has changed drives its new members, and
+    # one that's no longer a lead drives just itself
+    # consists is a list of [(addr, reversed)], one per consist, lead first
+    @classmethod
+    def reconsist(clazz, consists):
+        leads = {int(members[0][0]): members for members in consists}
+        with clazz.lock:
+            for (addr, state) in list(clazz._channels.items()):
+                if state.consist:
+                    DccChannel(addr).set_consist(leads.get(addr, []))
+
+    # Bracket every change to the state - must be called with DccChannel.lock held
+    def _changing(self):
+        self._state.version += 1
+
+    def _changed(self):
+        self._state.version += 1
+        self._state.changedAt = time.monotonic()
+        if self._state.watched is not None:
+            self._state.watched.notify_all()
+        if DccChannel.journal is not None:
+            DccChannel.journal.record(self._addr, self._state.throttle, self._state.speed, self._state.forwards)
+        for listener in DccChannel.listeners:
+            listener(self._addr)
+
+    # Put channels back into the state recorded in a StateJournal, eg after
+    # a restart: the run buffer carries on from the recorded speeds, and
+    # channels that were ramping carry on ramping towards their throttles
+    # states is a dict of addr: (throttle, speed, forwards)
+    # Raises TooManyAddresses if they don't all fit in the refresh stream
+    @classmethod
+    def restore(clazz, states):
+        for addr in states:
+            DccChannel(addr)._speedPackets()
+        with clazz.lock:
+            for (addr, (throttle, speed, forwards)) in states.items():
+                channel = DccChannel(addr)
+                channel._write(forwards, speed)
+                channel.throttle = throttle
+
+    # Set channels up to drive engines: lead is the address of the engine the
+    # throttle drives, and engines is a list of (addr, speedSteps, speedCurve,
+    # reversed) for it and the rest of its consist, if any
+    @classmethod
+    def configure(clazz, lead, acceleration, braking, engines):
+        for (addr, speedSteps, speedCurve, reversed) in engines:
+            DccChannel(addr).set_speed_curve(speedSteps, speedCurve)
+        channel = DccChannel(lead)
+        channel.acceleration = acceleration
+        channel.braking = braking
+        channel.set_consist([(addr, reversed) for (addr, speedSteps, speedCurve, reversed) in engines])
+        return channel
+
+    # Wait until this channel has changed since the given version, or until
+    # the timeout (in seconds) expires. Returns the current version
+    def wait_for_change(self, version, timeout=None):
+        with DccChannel.lock:
+            if self._state.watched is None:
+                self._state.watched = threading.Condition(DccChannel.lock)
+            self._state.watched.wait_for(lambda: self._state.version != version, timeout)
+            return self._state.version
+
+    # A consistent (throttle, speed, direction, version) for this channel,
+    # read without taking the lock
+    def snapshot(self):
+        state = self._state
+        while True:
+            version = state.version
+            snapshot = (state.throttle, state.speed, DccChannel.FORWARDS if state.forwards else DccChannel.BACKWARDS, version)
+            if version == state.version and version % 2 == 0:
+                return snapshot
+            # A change is being made - let the writer finish it
+            time.sleep(0)
+
+    # Apply throttle and/or direction changes to many channels at once, in a
+    # single pass over the run buffer
+    # changes is a list of (addr, throttle, direction) - use None for no change
+    # Every change is checked before any is made, so a bad one (which raises
+    # ValueError) doesn't leave the batch half applied
+    @classmethod
+    def update_many(clazz, changes):
+        changes = [(DccChannel(addr), throttle, direction) for (addr, throttle, direction) in changes]
+        for (channel, throttle, direction) in changes:
+            if throttle is not None and not 0 <= throttle <= 28:
+                raise ValueError("%s: throttle %s out of range" % (channel, throttle))
+            if direction not in [None, DccChannel.FORWARDS, DccChannel.BACKWARDS]:
+                raise ValueError("%s: direction %s isn't forwards or backwards" % (channel, direction))
+            channel._encodeConsist()
+        with clazz.lock:
+            for (channel, throttle, direction) in changes:
+                if throttle is not None:
+                    channel.throttle = throttle
+                if direction is not None:
+                    channel.direction = direction
+        return [channel for (channel, throttle, direction) in changes]
+
     @property
     def addr(self):
         assert self._valid()
         return self._addr
 
+    @property
+    def version(self):
+        return self._state.version
+
     @property
     def direction(self):
         assert self._valid()
-        (direction, speed) = DccChannel.peek_instruction(DccChannel.run_buffer, self._addr)
-        return DccChannel.FORWARDS if direction else DccChannel.BACKWARDS
+        assert self._verified()
+        return DccChannel.FORWARDS if self._state.forwards else DccChannel.BACKWARDS
 
     @direction.setter
     def direction(self, direction):
         assert self._valid()
         assert direction in [DccChannel.FORWARDS, DccChannel.BACKWARDS], str(direction)
-        (prevDirection, speed) = DccChannel.peek_instruction(DccChannel.run_buffer, self._addr)
-        if (speed == 0):
-            DccChannel.poke_instruction(DccChannel.run_buffer, self._addr, dcclib.speed_instruction(self._addr, direction == DccChannel.FORWARDS, 0))
+        self._encodeConsist()
+        with DccChannel.lock:
+            if (self._state.speed == 0):
+                self._write(direction == DccChannel.FORWARDS, 0)
 
     @property
     def speed(self):
         assert self._valid()
-        (direction, speed) = DccChannel.peek_instruction(DccChannel.run_buffer, self._addr)
-        return speed
+        assert self._verified()
+        return self._state.speed
 
     @speed.setter
     def speed(self, speed):
         assert self._valid()
         assert speed >= 0
         assert speed <= 28
-        (direction, prevSpeed) = DccChannel.peek_instruction(DccChannel.run_buffer, self._addr)
-        DccChannel.poke_instruction(DccChannel.run_buffer, self._addr, dcclib.speed_instruction(self._addr, direction, speed))
-
-    def _setSpeed(self, speed):
-        (direction, prevSpeed) = DccChannel.peek_instruction(DccChannel.run_buffer, self._addr)
-        DccChannel.poke_instruction(DccChannel.run_buffer, self._addr, dcclib.speed_instruction(self._addr, direction, speed))
+        self._encodeConsist()
+        self._write(self._state.forwards, speed)
 
     @property
     def throttle(self):
         assert self._valid()
-        return self._channels[self._addr]["throttle"]
+        return self._state.throttle
 
     @throttle.setter
     def throttle(self, throttle):
         assert self._valid()
         assert throttle >= 0
         assert throttle <= 28
-        self._setSpeedAdjuster(throttle)
-        self._channels[self._addr]["throttle"] = throttle
+        if throttle != 0:
+            self._encodeConsist()
+        with DccChannel.lock:
+            # Any throttle change ends an emergency stop - every channel
+            # was stopped, so only this one can start moving
+            if DccChannel.packets.stopped:
+                DccChannel.packets.resume()
+            # Make sure there's room to refresh the channel (and the rest of
+            # the consist) before it's given a throttle to ramp towards
+            if throttle != 0 and any(channel._addr not in DccChannel.packets for channel in self._consistChannels()):
+                self._write(self._state.forwards, self._state.speed)
+            self._setThrottle(throttle)
+            # The rest of the consist shows the same throttle, but isn't
+            # ramped separately
+            for (member, reversed) in self._state.consist:
+                member._setThrottle(throttle)
+            self._setSpeedAdjuster(throttle)
+
+    # This channel, and the rest of its consist, if any
+    def _consistChannels(self):
+        return [self] + [member for (member, reversed) in self._state.consist]
+
+    # Must be called with DccChannel.lock held
+    def _setThrottle(self, throttle):
+        self._changing()
+        self._state.throttle = throttle
+        self._changed()
+
+    # Loco functions, as a bitfield with bit n set if Fn is on
+    @property
+    def functions(self):
+        assert self._valid()
+        return self._state.functions
 
-    def _setSpeedAdjuster(self, destinationSpeed):
-        # How does the required speed compare to the current speed...
-        currentSpeed = self.speed
+    # Only the groups of functions that have changed are written, and a group
+    # is refreshed from when it's first changed on
+    @functions.setter
+    def functions(self, functions):
+        assert self._valid()
+        assert 0 <= functions < (1 << (dcclib.MAX_FUNCTION + 1))
+        self._setFunctions(lambda current: functions)
+
+    # Whether function Fn is on
+    def function(self, n):
+        assert 0 <= n <= dcclib.MAX_FUNCTION
+        return (self._state.functions >> n) & 1 == 1
+
+    def set_function(self, n, on):
+        assert 0 <= n <= dcclib.MAX_FUNCTION
+        bit = 1 << n
+        self._setFunctions(lambda current: current | bit if on else current & ~bit)
+
+    # Change the functions to change(current functions): the packets for the
+    # groups that change are encoded first, and the lock only taken to
+    # publish them - if the functions change meanwhile, it goes round again
+    def _setFunctions(self, change):
+        state = self._state
+        while True:
+            current = state.functions
+            functions = change(current)
+            packets = self._functionPackets(functions, functions ^ current)
+            with DccChannel.lock:
+                if state.functions != current:
+                    continue
+                if functions == current:
+                    return
+                for (group, packet) in packets.items():
+                    DccChannel.poke_functions(DccChannel.packets, self._addr, group, packet)
+                self._changing()
+                state.functions = functions
+                self._changed()
+                return
+
+    # The packets setting each group of functions that's in changed to
+    # functions, by group
+    def _functionPackets(self, functions, changed):
+        return {group: dcclib.packet_cache.encode(dcclib.function_instruction(self._addr, group, functions))
+            for group in range(len(dcclib.FUNCTION_GROUPS)) if changed & dcclib.function_group_mask(group)}
+
+    # Acceleration and braking are a percentage of MAX_RAMP_RATE, as
+    # stored on the Engine being driven on this channel
+    @property
+    def acceleration(self):
+        assert self._valid()
+        return 100 * self._state.accelerationRate / DccChannel.MAX_RAMP_RATE
 
-        # Work out how to adjust the speed, if at all
-        requiredAdjustment = destinationSpeed - currentSpeed
-        # Also work out the current adjustment that's being applied
-        currentAdjustment = self.throttle - currentSpeed
+    @acceleration.setter
+    def acceleration(self, acceleration):
+        assert self._valid()
+        assert 0 < int(acceleration) <= 100
+        self._state.accelerationRate = DccChannel.MAX_RAMP_RATE * int(acceleration) / 100
 
-        if requiredAdjustment == 0:
-            # We're now going at the desired speed
-            # Scheduled callback will handle this and tidy up when it next runs
-            return
+    @property
+    def braking(self):
+        assert self._valid()
+        return 100 * self._state.brakingRate / DccChannel.MAX_RAMP_RATE
+
+    @braking.setter
+    def braking(self, braking):
+        assert self._valid()
+        assert 0 < int(braking) <= 100
+        self._state.brakingRate = DccChannel.MAX_RAMP_RATE * int(braking) / 100
 
-        # Compare the signs on the adjustments, by seeing if they cancel when multiplied
-        posNegOrZero = requiredAdjustment * currentAdjustment
-        if posNegOrZero > 0:
-            # Not yet going at the right speed, but the required speed
-            # is in the same "direction" as the current target speed
-            # No need to do anything - existing schedule will
-            # continue to work for us
+    # Must be called with DccChannel.lock held
+    def _setSpeedAdjuster(self, destinationSpeed):
+        if destinationSpeed == self._state.speed:
+            # We're now going at the desired speed
+            # The ramping loop will tidy up when it next runs
             return
+        # Hand the channel over to the ramping loop, if it's not already there
+        if self._addr not in DccChannel._ramping:
+            self._state.rampProgress = 0.0
+            DccChannel._ramping.add(self._addr)
+            DccChannel._rampCondition.notify()
+
+    # The speed ramping loop: a single thread that ticks every RAMP_INTERVAL
+    # while any channel is ramping, and sleeps otherwise
+    @classmethod
+    def _rampLoop(clazz):
+        while True:
+            with clazz._rampCondition:
+                while not clazz._ramping or clazz.manualRamping:
+                    clazz._rampCondition.wait()
+            lastTick = time.monotonic()
+            deadline = lastTick + clazz.RAMP_INTERVAL
+            while clazz._ramping and not clazz.manualRamping:
+                time.sleep(max(0, deadline - time.monotonic()))
+                now = time.monotonic()
+                clazz._recordLateness(now - deadline)
+                clazz._adjustSpeeds(now - lastTick)
+                lastTick = now
+                deadline += clazz.RAMP_INTERVAL
+                if deadline < now:
+                    # Too far behind to catch up - skip the missed ticks
+                    deadline = now + clazz.RAMP_INTERVAL
 
-        # Either we're starting to move, or we're changing between accelerating and decelerating
-        self._channels[self._addr]["speedAdjusterJob"].reschedule("interval", seconds=0.2)
+    @classmethod
+    def _recordLateness(clazz, lateness):
+        clazz.rampTicks += 1
+        clazz.rampLateness.append(lateness)
+        clazz.rampMaxLateness = max(clazz.rampMaxLateness, lateness)
+
+    # Move every ramping channel towards its throttle setting, at its own
+    # rate, given the time elapsed (in seconds) since the previous tick
+    # The whole tick is one change to the run buffer, made with the lock held,
+    # so it can't interleave with a change being made by a cab
+    @classmethod
+    def _adjustSpeeds(clazz, elapsed):
+        with clazz.lock:
+            for addr in list(clazz._ramping):
+                self = DccChannel(addr)
+                state = self._state
+                currentSpeed = state.speed
+                destinationSpeed = state.throttle
+                # Work out how to adjust the speed, if at all
+                adjustment = sign(destinationSpeed - currentSpeed)
+                if adjustment != 0:
+                    state.rampProgress += elapsed * (state.accelerationRate if adjustment > 0 else state.brakingRate)
+                    steps = min(int(state.rampProgress), abs(destinationSpeed - currentSpeed))
+                    # If speed needs adjusting, adjust it
+                    if steps > 0:
+                        state.rampProgress -= steps
+                        currentSpeed = currentSpeed + adjustment * steps
+                        self._write(state.forwards, currentSpeed)
+                # If now going at the right speed, stop ramping this channel
+                if currentSpeed == destinationSpeed:
+                    clazz._ramping.discard(addr)
+
+    # Stop every loco, now: the refresh stream is replaced by broadcast
+    # emergency stops, all ramping is abandoned, and every channel's throttle
+    # and speed are zeroed, all in one change to the run buffer. The stream
+    # stays stopped until a throttle is next changed
+    # If wait is set, returns as wait_for_stop
+    @classmethod
+    def emergency_stop(clazz, wait=True):
+        start = time.perf_counter()
+        with clazz.lock:
+            clazz.packets.stop()
+            clazz.stops += 1
+            clazz._ramping.clear()
+            for (addr, state) in list(clazz._channels.items()):
+                channel = DccChannel(addr)
+                if state.throttle != 0:
+                    channel._setThrottle(0)
+                if state.speed != 0:
+                    # From the channel's table - no encoding
+                    channel._writeOne(state.forwards, 0)
+        return clazz.wait_for_stop(start) if wait else None
+
+    # Wait for an emergency stop to be published to the run buffer, and
+    # return how long (in seconds) that took since start (by
+    # time.perf_counter()), or None if it wasn't in time
+    @classmethod
+    def wait_for_stop(clazz, start):
+        if not clazz.run_buffer.flush(2 * clazz.packets.max_latency()):
+            return None
+        latency = time.perf_counter() - start
+        clazz.stopLatencies.append(latency)
+        clazz.stopMaxLatency = max(clazz.stopMaxLatency, latency)
+        return latency
 
     @classmethod
-    def _adjustSpeeds(clazz, addr):
-        self = DccChannel(addr)
-        currentSpeed = self.speed
-        destinationSpeed = self._channels[self._addr]["throttle"]
-        # Work out how to adjust the speed, if at all
-        adjustment = sign(destinationSpeed - currentSpeed)
-        # If speed needs adjusting, adjust it
-        if adjustment != 0:
-            currentSpeed = currentSpeed + adjustment
-            self.speed = currentSpeed
-        # If now going at the right speed, pause the speedAdjuster
-        if currentSpeed == destinationSpeed:
-            self._channels[self._addr]["speedAdjusterJob"].pause()
+    def stop_status(clazz):
+        latencies = list(clazz.stopLatencies)
+        return {
+            "stopped": clazz.packets.stopped,
+            "stops": clazz.stops,
+            "lastLatency": latencies[-1] if latencies else 0.0,
+            "maxLatency": clazz.stopMaxLatency,
+        }
+
+    # Report on the timeliness of the speed ramping loop
+    @classmethod
+    def ramp_status(clazz):
+        lateness = list(clazz.rampLateness)
+        return {
+            "ticks": clazz.rampTicks,
+            "ramping": len(clazz._ramping),
+            "lastLateness": lateness[-1] if lateness else 0.0,
+            "meanLateness": sum(lateness) / len(lateness) if lateness else 0.0,
+            "maxLateness": clazz.rampMaxLateness,
+        }
 
 # Complete initialisation of the class
 DccChannel.__phase2__()
@@ -188,6 +735,7 @@ DccChannel.__phase2__()
 def unit_test():
     assert DccChannel(1).addr == 1
     assert DccChannel(2).addr == 2
+    assert DccChannel(DccChannel.MAX_ADDR).addr == DccChannel.MAX_ADDR
     a = DccChannel(5)
     assert a.speed == 0
     a.direction = DccChannel.BACKWARDS
@@ -204,8 +752,250 @@ def unit_test():
     a.speed = 0
     a.throttle = 0
     a.direction = DccChannel.FORWARDS
-
-DccChannel.poke_instruction(DccChannel.run_buffer, 0, dcclib.idle_instruction())
-for addr in range(1, DccChannel.MAX_ADDR):
-    DccChannel.poke_instruction(DccChannel.run_buffer, addr, dcclib.speed_instruction(addr, True, 0))
-
+    a.acceleration = 20
+    assert a.acceleration == 20
+    a.throttle = 6
+    assert 5 in DccChannel._ramping
+    DccChannel._adjustSpeeds(1.0)
+    assert 1 <= a.speed <= 6
+    DccChannel._adjustSpeeds(100.0)
+    assert a.speed == 6
+    assert 5 not in DccChannel._ramping
+    a.acceleration = 100
+    a.speed = 0
+    a.throttle = 0
+    version = a.version
+    a.throttle = 0
+    assert a.wait_for_change(version, 0) == version + 2
+    assert a.wait_for_change(version + 2, 0) == version + 2
+    assert a.snapshot() == (0, 0, DccChannel.FORWARDS, version + 2)
+    (c, d) = DccChannel.update_many([(6, None, DccChannel.BACKWARDS), (7, 3, None)])
+    assert c.direction == DccChannel.BACKWARDS
+    assert d.throttle == 3
+    DccChannel.update_many([(6, None, DccChannel.FORWARDS), (7, 0, None)])
+    try:
+        DccChannel.update_many([(6, 5, None), (7, 99, None)])
+        assert False, "Bad throttle accepted"
+    except ValueError:
+        assert DccChannel(6).throttle == 0
+    DccChannel.restore({8: (0, 3, False)})
+    e = DccChannel(8)
+    assert (e.throttle, e.speed, e.direction) == (0, 3, DccChannel.BACKWARDS)
+    assert 8 in DccChannel._ramping
+    e.speed = 0
+    e.direction = DccChannel.FORWARDS
+    f = DccChannel(9)
+    version = f.version
+    f.set_function(0, True)
+    f.set_function(13, True)
+    assert f.function(0) and f.function(13) and not f.function(1)
+    assert f.functions == (1 << 0) | (1 << 13)
+    assert f.version == version + 4
+    f.set_function(0, True)
+    assert f.version == version + 4
+    assert (9, 0) in DccChannel.packets._background
+    assert (9, 3) in DccChannel.packets._background
+    assert (9, 1) not in DccChannel.packets._background
+    f.functions = 0
+    assert not f.function(13)
+    # Groups stay in the refresh once used, so every decoder hears them turn off
+    assert dcclib.decode_instruction(dcclib.packet_cache.decode(DccChannel.packets._background[(9, 3)])) == (9, "FUNCTIONS", (3, 0))
+    g = DccChannel(10)
+    g.set_speed_curve(128, [10, 100])
+    g.speed = 1
+    assert DccChannel.peek_instruction(DccChannel.packets, 10) == (True, 13)
+    g.speed = 28
+    assert DccChannel.peek_instruction(DccChannel.packets, 10) == (True, 126)
+    g.set_speed_curve(28)
+    assert DccChannel.peek_instruction(DccChannel.packets, 10) == (True, 28)
+    g.speed = 0
+    h = DccChannel(14)
+    h.throttle = 9
+    h.speed = 5
+    assert DccChannel.emergency_stop() is not None
+    assert DccChannel.packets.stopped
+    assert (h.throttle, h.speed) == (0, 0) and 14 not in DccChannel._ramping
+    assert dcclib.decode_many(DccChannel.run_buffer.front.frame()) == [(0, "STOP", (1,))] * DccChannel.packets.URGENT_REPEATS
+    assert DccChannel.verify_run_buffer()
+    assert DccChannel.stop_status()["maxLatency"] > 0
+    h.throttle = 0
+    assert not DccChannel.packets.stopped
+    (lead, second, third) = (DccChannel(11), DccChannel(12), DccChannel(13))
+    second.throttle = 5
+    lead.set_consist([(11, False), (12, False), (13, True)])
+    assert 12 not in DccChannel._ramping
+    assert second.throttle == 0
+    lead.throttle = 4
+    assert third.throttle == 4 and DccChannel._ramping & {11, 12, 13} == {11}
+    DccChannel._adjustSpeeds(100.0)
+    assert (second.speed, second.direction) == (4, DccChannel.FORWARDS)
+    assert (third.speed, third.direction) == (4, DccChannel.BACKWARDS)
+    lead.throttle = 0
+    lead.speed = 0
+    lead.direction = DccChannel.BACKWARDS
+    assert (second.direction, third.direction) == (DccChannel.BACKWARDS, DccChannel.FORWARDS)
+    lead.direction = DccChannel.FORWARDS
+    lead.set_consist([])
+    lead.speed = 2
+    assert second.speed == 0
+    lead.speed = 0
+    DccChannel.verify = True
+    try:
+        g.set_speed_curve(128)
+        g.speed = 14
+        assert g.speed == 14
+        assert DccChannel.verify_run_buffer()
+        g.speed = 0
+        c = DccChannel(3000)
+        c.speed = 4
+        assert c.speed == 4
+        c.speed = 0
+        a.speed = 7
+        assert a.speed == 7
+        assert a.direction == DccChannel.FORWARDS
+        a.speed = 0
+        a.direction = DccChannel.BACKWARDS
+        assert a.direction == DccChannel.BACKWARDS
+        a.direction = DccChannel.FORWARDS
+        assert DccChannel.verify_run_buffer()
+    finally:
+        DccChannel.verify = False
+    # Consists follow the shed: a deleted member is no longer driven...
+    (lead, member, other) = (DccChannel(18), DccChannel(19), DccChannel(20))
+    lead.set_consist([(18, False), (19, False)])
+    lead.speed = 3
+    DccChannel.reconsist([])
+    member.release()
+    lead.speed = 5
+    assert 19 not in DccChannel.packets and member.speed == 0
+    # ...and a changed consist drives its new members
+    lead.set_consist([(18, False), (19, False)])
+    DccChannel.reconsist([[(18, False), (20, True)]])
+    lead.speed = 4
+    assert (member.speed, other.speed, other.direction) == (5, 4, DccChannel.BACKWARDS)
+    lead.speed = 0
+    lead.set_consist([])
+    for channel in [lead, member, other]:
+        channel.speed = 0
+        channel.release()
+    # Released channels take no track time, until they're next written to
+    i = DccChannel(17)
+    i.speed = 3
+    i.set_function(0, True)
+    i.release()
+    assert 17 not in DccChannel.packets and (17, 0) not in DccChannel.packets._background
+    assert (i.speed, i.functions) == (0, 0)
+    i.speed = 1
+    assert 17 in DccChannel.packets
+    i.release()
+    # Nothing is encoded while the lock is held
+    encode = dcclib.packet_cache.encode
+    def unlockedEncode(instruction):
+        assert not DccChannel.lock._is_owned(), "Encoding with DccChannel.lock held"
+        return encode(instruction)
+    dcclib.packet_cache.encode = unlockedEncode
+    try:
+        i.set_speed_curve(128, [10, 100])
+        i.throttle = 5
+        i.direction = DccChannel.BACKWARDS
+        i.functions = 0x3
+        i.set_function(13, True)
+        i.speed = 2
+        i.release()
+        DccChannel.update_many([(17, 4, None)])
+        i.release()
+    finally:
+        del dcclib.packet_cache.encode
+    i.set_speed_curve(28)
+    # Channels at rest make way for others once the frame's full, but moving
+    # ones don't
+    for addr in range(200, 400):
+        DccChannel(addr).direction = DccChannel.FORWARDS
+    assert 399 in DccChannel.packets
+    try:
+        for addr in range(200, 400):
+            DccChannel(addr).speed = 1
+        assert False, "Too many addresses accepted"
+    except TooManyAddresses:
+        pass
+    for addr in range(200, 400):
+        DccChannel(addr).speed = 0
+        DccChannel(addr).release()
+
+
+# Hammer throttle and direction changes at channels from many threads at
+# once, while the speed ramping loop runs, and (if check is set) check no
+# change was lost. Returns the number of changes made per second
+def stress_test(threads=8, changes=500, firstAddr=100, check=True):
+    import random
+    addrs = range(firstAddr, firstAddr + threads)
+    expected = {}
+    errors = []
+    done = threading.Event()
+
+    # Each thread drives its own channel, through all the ways there are
+    def drive(addr):
+        rng = random.Random(addr)
+        channel = DccChannel(addr)
+        throttle = channel.throttle
+        forwards = channel.direction
+        for i in range(changes):
+            choice = rng.random()
+            if choice < 0.1:
+                # Stop dead and reverse, racing the ramping loop
+                channel.throttle = 0
+                channel.speed = 0
+                forwards = -forwards
+                channel.direction = forwards
+                throttle = 0
+            elif choice < 0.2:
+                throttle = rng.randrange(29)
+                DccChannel.update_many([(addr, throttle, None)])
+            else:
+                throttle = rng.randrange(29)
+                channel.throttle = throttle
+        expected[addr] = (throttle, forwards)
+
+    # Readers must always see a consistent channel
+    def read():
+        while not done.is_set():
+            for addr in addrs:
+                (throttle, speed, forwards, version) = DccChannel(addr).snapshot()
+                if not (0 <= throttle <= 28 and 0 <= speed <= 28 and version % 2 == 0):
+                    errors.append((addr, throttle, speed, forwards, version))
+
+    reader = threading.Thread(target=read, daemon=True)
+    reader.start()
+    drivers = [threading.Thread(target=drive, args=(addr,)) for addr in addrs]
+    start = time.perf_counter()
+    for driver in drivers:
+        driver.start()
+    for driver in drivers:
+        driver.join()
+    elapsed = time.perf_counter() - start
+    done.set()
+    reader.join()
+    assert not errors, "Inconsistent reads: %s" % errors[:5]
+
+    # The last change each thread made to its own channel must have stuck
+    for addr in (addrs if check else []):
+        channel = DccChannel(addr)
+        (throttle, forwards) = expected[addr]
+        assert channel.throttle == throttle, "%s: lost throttle change" % channel
+        assert channel.direction == forwards, "%s: lost direction change" % channel
+    # Finish ramping, racing the ramping loop to do so
+    deadline = time.monotonic() + 5
+    while check and any(DccChannel(addr).speed != DccChannel(addr).throttle for addr in addrs):
+        assert time.monotonic() < deadline, "Ramping never finished"
+        DccChannel._adjustSpeeds(100.0)
+    if check:
+        DccChannel.verify = True
+        try:
+            assert DccChannel.verify_run_buffer()
+        finally:
+            DccChannel.verify = False
+    for addr in addrs:
+        channel = DccChannel(addr)
+        channel.throttle = 0
+        channel.speed = 0
+    return threads * changes / elapsed
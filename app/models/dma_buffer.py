@@ -18,8 +18,17 @@
 
 """DMA buffer model
 
-A block of memory that can be streamed by DMA"""
+A block of memory that can be streamed by DMA.
 
+Buffers are ordinary process memory by default. They can instead be
+carved out of a DmaMemory - a file or device (eg /dev/mem) mapped with
+mmap - so that other processes (a hardware driver, a logger, a test
+harness) can read the live refresh stream straight out of the mapping"""
+
+import mmap
+import os
+import struct
+import threading
 from ctypes import *
 
 c_ubyte_p = POINTER(c_ubyte)
@@ -31,19 +40,30 @@ def _aligned(address, alignment):
 
 class DmaBuffer:
 
-    def __init__(self, size, dest):
+    # memory, if given, is a writable buffer (eg an mmap) to place the
+    # control block and data in, at offset (which must be 32 byte aligned)
+    # busAddress is the address of the control block as the DMA engine
+    # sees it, if that's not its address in this process
+    def __init__(self, size, dest, memory=None, offset=0, busAddress=None):
         assert size & 31 == 0, "DMA buffer must be a multiple of 32 bytes"
         # Instance attributes:
         self.size = size
-        self.memory = (c_ubyte * (32 + 32 + size))()
-        aligned_address = _aligned(addressof(self.memory), 32)
+        self.offset = offset
+        if memory is None:
+            self.memory = (c_ubyte * (32 + 32 + size))()
+            aligned_address = _aligned(addressof(self.memory), 32)
+        else:
+            assert offset & 31 == 0, "DMA buffer must be 32 byte aligned"
+            self.memory = (c_ubyte * (32 + size)).from_buffer(memory, offset)
+            aligned_address = addressof(self.memory)
         self.header = (c_uint32 * 8).from_address(aligned_address)
         self.buffer = (c_ubyte * size).from_address(aligned_address + 32)
+        self.busAddress = aligned_address if busAddress is None else busAddress
 
         # Set up DMA control block
         self.header[0:8] = [
             0x00050148,           # Transfer info
-            aligned_address + 32, # Data source (self.buffer)
+            self.busAddress + 32, # Data source (self.buffer)
             dest,                 # Data destination
             size,                 # Amount of data
             0,                    # Stride (N/A)
@@ -54,10 +74,18 @@ class DmaBuffer:
         assert self._valid()
 
     def set_next_buffer(self, next_buffer):
-        assert self.valid()
+        assert self._valid()
         assert next_buffer
-        assert next_buffer.valid()
-        self.header[5] = addressof(next_buffer.header)
+        assert next_buffer._valid()
+        self.header[5] = next_buffer.busAddress
+
+    # Zero-copy access - a writable memoryview of the whole buffer
+    def view(self):
+        return memoryview(self.buffer).cast("B")
+
+    # Zero-copy access - the part of the buffer the DMA engine streams
+    def frame(self):
+        return self.view()[:self.header[3]]
 
     # Peek method - ie a = dmaBuffer[5] or a = dmaBuffer[4:7]
     def __getitem__(self, index):
@@ -82,6 +110,11 @@ class DmaBuffer:
     @staticmethod
     def unit_test():
         print("unit testing DmaBuffer")
+        buffer0 = DmaBuffer(64, 0)
+        buffer0.view()[0:3] = b"\x01\x02\x03"
+        assert buffer0[0:3] == [1, 2, 3]
+        buffer0.header[3] = 2
+        assert buffer0.frame().tobytes() == b"\x01\x02"
         buffer1 = DmaBuffer(128, 0)
         buffer1.buffer[18] = 45
         assert buffer1[18] == 45
@@ -91,3 +124,110 @@ class DmaBuffer:
         buffer1[4:8] = buffer1[0:4]
         assert buffer1[7] == 4
 
+
+# A file or device mapped into memory, that DMA buffers are allocated from
+#
+# The mapping starts with a directory block, so that other processes can
+# find the buffer currently being streamed: magic, sequence, offset and
+# length of the live frame. The sequence is odd while the directory is
+# being changed, so readers can tell if they've seen a half made change
+class DmaMemory(object):
+    # Class constants:
+    MAGIC = b"DCCm"
+    DIRECTORY = struct.Struct("<4sIII")
+
+    # size is the number of bytes to map (default, the whole of an existing
+    # file); offset is where in the file or device to map from
+    # busAddress is the address of the start of the mapping as the DMA
+    # engine sees it, eg the physical address mapped from /dev/mem
+    def __init__(self, path, size=None, offset=0, busAddress=None, readonly=False):
+        # Instance attributes:
+        self.path = path
+        self.busAddress = busAddress
+        self.readonly = readonly
+        fd = os.open(path, os.O_RDONLY if readonly else os.O_RDWR | os.O_CREAT)
+        try:
+            if size is None:
+                size = os.fstat(fd).st_size - offset
+            elif not readonly and os.path.isfile(path) and os.fstat(fd).st_size < offset + size:
+                os.ftruncate(fd, offset + size)
+            self.size = size
+            self.map = mmap.mmap(fd, size, offset=offset, access=mmap.ACCESS_READ if readonly else mmap.ACCESS_WRITE)
+        finally:
+            os.close(fd)
+        self._next = 32
+        self._lock = threading.Lock()
+        if not readonly:
+            DmaMemory.DIRECTORY.pack_into(self.map, 0, DmaMemory.MAGIC, 0, 0, 0)
+        assert self._valid()
+
+    # The number of bytes needed to hold the given buffers, plus the directory
+    @staticmethod
+    def size_for(*sizes):
+        return 32 + sum(32 + size for size in sizes)
+
+    def allocate(self, size, dest):
+        assert not self.readonly
+        with self._lock:
+            offset = self._next
+            assert offset + 32 + size <= self.size, "DmaMemory is full"
+            self._next = _aligned(offset + 32 + size, 32)
+        busAddress = None if self.busAddress is None else self.busAddress + offset
+        return DmaBuffer(size, dest, self.map, offset, busAddress)
+
+    # Record buffer (allocated from this memory) as the one being streamed
+    def publish(self, buffer):
+        (magic, sequence, offset, length) = DmaMemory.DIRECTORY.unpack_from(self.map, 0)
+        DmaMemory.DIRECTORY.pack_into(self.map, 0, magic, sequence + 1, offset, length)
+        DmaMemory.DIRECTORY.pack_into(self.map, 0, magic, sequence + 2, buffer.offset, buffer.header[3])
+
+    # The sequence number of the latest publish
+    def sequence(self):
+        return DmaMemory.DIRECTORY.unpack_from(self.map, 0)[1]
+
+    # Zero-copy access to the frame being streamed, as (sequence, memoryview)
+    # The frame is only sure to have been intact if sequence() still returns
+    # the same number once the caller has finished with it
+    def live(self):
+        while True:
+            (magic, sequence, offset, length) = DmaMemory.DIRECTORY.unpack_from(self.map, 0)
+            assert magic == DmaMemory.MAGIC, "%s is not a DmaMemory" % self.path
+            if sequence % 2 == 0:
+                view = memoryview(self.map)[offset + 32:offset + 32 + length]
+                if self.sequence() == sequence:
+                    return (sequence, view)
+
+    def close(self):
+        self.map.close()
+
+    def __repr__(self):
+        return "DmaMemory[path=%s,size=%d]" % (self.path, self.size)
+
+    def _valid(self):
+        assert self.size > 32
+        return True
+
+    @staticmethod
+    def unit_test():
+        print("unit testing DmaMemory")
+        import tempfile
+        path = os.path.join(tempfile.mkdtemp(), "dma")
+        memory = DmaMemory(path, DmaMemory.size_for(64, 64), busAddress=0x40000000)
+        (a, b) = (memory.allocate(64, 0), memory.allocate(64, 0))
+        assert (a.offset, b.offset) == (32, 128)
+        assert a.header[1] == 0x40000000 + 32 + 32
+        a.set_next_buffer(b)
+        assert a.header[5] == 0x40000000 + 128
+        a.view()[0:4] = b"\x0a\x0b\x0c\x0d"
+        a.header[3] = 4
+        memory.publish(a)
+        # Another process, reading the same file
+        reader = DmaMemory(path, readonly=True)
+        (sequence, frame) = reader.live()
+        assert frame.tobytes() == b"\x0a\x0b\x0c\x0d"
+        assert reader.sequence() == sequence == 2
+        b.header[3] = 0
+        memory.publish(b)
+        assert reader.sequence() != sequence
+        assert reader.live()[1].tobytes() == b""
+        frame.release()
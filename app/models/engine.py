@@ -18,7 +18,7 @@
 
 """Engine model"""
 from sqlalchemy import Column
-from sqlalchemy.types import Integer, String
+from sqlalchemy.types import Boolean, Integer, String
 
 from app.models import Base
 
@@ -33,12 +33,38 @@ class Engine(Base):
     acceleration = Column(Integer)
     braking = Column(Integer)
 
-    def __init__(self, nickname='', addr=0, maxSpeed=28, acceleration=100, braking=100):
+    # 28 or 128 speed step mode
+    speedSteps = Column(Integer)
+    # Percentages of top speed at evenly spaced throttle notches, comma
+    # separated - empty for a straight line
+    speedCurve = Column(String(200))
+
+    # Engines with the same consist name are driven together, as one, by
+    # whichever of them was added first - empty for an engine driven alone
+    consist = Column(String(100))
+    # Set if the engine faces the other way to the rest of its consist
+    consistReversed = Column(Boolean)
+
+    def __init__(self, nickname='', addr=0, maxSpeed=28, acceleration=100, braking=100, speedSteps=28, speedCurve='', consist='', consistReversed=False):
         self.nickname = nickname
         self.addr = addr
         self.maxSpeed = maxSpeed
         self.acceleration = acceleration
         self.braking = braking
+        self.speedSteps = speedSteps
+        self.speedCurve = speedCurve
+        self.consist = consist
+        self.consistReversed = consistReversed
+
+    # Parse a speed curve, eg "10, 50, 100", into a tuple of percentages
+    # Empty curves (including those of rows made before there were curves) are None
+    # Raises ValueError if it isn't a list of whole percentages
+    @staticmethod
+    def parse_curve(text):
+        points = tuple(int(point) for point in (text or "").replace(",", " ").split())
+        if not all(0 <= point <= 100 for point in points):
+            raise ValueError("Speed curve points must be percentages")
+        return points or None
 
     def __repr__(self):
         return "Engine[nickname=%s,addr=%s]" % (self.nickname, self.addr)
@@ -0,0 +1,279 @@
+# DCC - Digital Command Control command station
+# Copyright (C) 2018 Simon Howkins
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# Source for this program is published at https://github.com/simonhowkins/dcc
+
+"""Packet scheduler model
+
+Decides what goes into each frame of the track refresh stream:
+* Urgent packets (eg emergency stop) go first, as soon as they're sent
+* Packets for recently changed addresses go next, and are repeated later
+  in the frame, for the next few frames
+* Then the current packet for every address in use
+* Then some of the background packets (eg loco functions), round-robin, so
+  they're refreshed less often than speed packets and don't slow them down
+* An idle packet if there is nothing else to send
+
+While stopped (see stop()) every frame is just broadcast emergency stops,
+however many addresses are in use, until resume()
+
+Addresses that have never been written to take up no track time at all"""
+
+from collections import OrderedDict
+
+from app.services import dcclib
+
+# Raised when a packet for another address won't fit in the frame
+class TooManyAddresses(Exception):
+    pass
+
+class PacketScheduler(object):
+    # Class constants:
+    # Number of frames in which a changed packet is sent an extra time
+    CHANGE_FRAMES = 3
+    # Number of times an urgent packet is sent, back to back
+    URGENT_REPEATS = 4
+    # Background packets take up at most this fraction of the regular packets'
+    # time in each frame (but at least one is sent in every frame)
+    BACKGROUND_SHARE = 0.25
+
+    def __init__(self, chain):
+        # Instance attributes:
+        self.chain = chain
+        self.lock = chain.lock
+        # The current packet (as DMA bytes) for each address in use
+        self._packets = OrderedDict()
+        # Total length of those packets
+        self._size = 0
+        # Background packets, by key (eg (addr, function group)), in the order
+        # they'll next be sent
+        self._background = OrderedDict()
+        # Number of frames each recently changed address (or background key)
+        # still gets an extra send in
+        self._boost = OrderedDict()
+        self._urgent = []
+        self._idle = dcclib.to_dma_bytes(dcclib.idle_instruction())
+        self._stop = dcclib.to_dma_bytes(dcclib.stop_instruction(True)) * PacketScheduler.URGENT_REPEATS
+        self.stopped = False
+        chain.compose = self.frame
+        assert self._valid()
+
+    # The packet currently being refreshed for an address, if any
+    def __getitem__(self, addr):
+        return self._packets.get(addr)
+
+    def __contains__(self, addr):
+        return addr in self._packets
+
+    # Whether a packet of the given length, for another address, would fit
+    # At most half the frame is used for these, to leave room for the extra sends
+    def has_room(self, size):
+        return self._size + size <= self.chain.size // 2
+
+    # Set the packet to refresh for an address
+    def update(self, addr, packet):
+        with self.lock:
+            if addr not in self._packets and not self.has_room(len(packet)):
+                raise TooManyAddresses("Too many addresses in use to fit in a frame")
+            if self._packets.get(addr) != packet:
+                self._size += len(packet) - len(self._packets.get(addr, b""))
+                self._packets[addr] = packet
+                self._boost[addr] = PacketScheduler.CHANGE_FRAMES
+                self._boost.move_to_end(addr)
+                self.chain.invalidate()
+
+    # Stop refreshing an address
+    def remove(self, addr):
+        with self.lock:
+            packet = self._packets.pop(addr, None)
+            if packet is not None:
+                self._size -= len(packet)
+                self._boost.pop(addr, None)
+                self.chain.invalidate()
+
+    # Set a background packet to refresh, under any key other than an address
+    # There's no limit on how many there are, as only a share of them go in
+    # each frame - the more there are, the less often each is refreshed
+    def update_background(self, key, packet):
+        with self.lock:
+            if self._background.get(key) != packet:
+                self._background[key] = packet
+                self._boost[key] = PacketScheduler.CHANGE_FRAMES
+                self._boost.move_to_end(key)
+                self.chain.invalidate()
+
+    def remove_background(self, key):
+        with self.lock:
+            if self._background.pop(key, None) is not None:
+                self._boost.pop(key, None)
+                self.chain.invalidate()
+
+    # Send a packet at the start of the very next frame
+    def send_now(self, packet, repeats=URGENT_REPEATS):
+        with self.lock:
+            self._urgent.append((packet, repeats))
+            self.chain.invalidate()
+
+    # Replace the whole refresh stream with broadcast emergency stops, from
+    # the very next frame - a short one, so it's quick to publish and repeats
+    # often - until resume()
+    def stop(self):
+        with self.lock:
+            self.stopped = True
+            self._urgent = []
+            self.chain.invalidate()
+
+    # Go back to refreshing every address
+    def resume(self):
+        with self.lock:
+            if self.stopped:
+                self.stopped = False
+                self.chain.invalidate()
+
+    # Build the next frame - called by the refresh chain with the lock held
+    def frame(self):
+        if self.stopped:
+            return self._stop
+        boosted = [self._packets[key] if key in self._packets else self._background[key] for key in self._boost]
+        regular = list(self._packets.values())
+        background = self._background_slice()
+        size = self._size + sum(map(len, background))
+        # Urgent packets go first, as many as there's room for - the rest go
+        # at the start of the next frame
+        urgent = []
+        while self._urgent and size + len(self._urgent[0][0]) * self._urgent[0][1] <= self.chain.size:
+            (packet, repeats) = self._urgent.pop(0)
+            urgent += [packet] * repeats
+            size += len(packet) * repeats
+        if self._urgent:
+            self.chain.invalidate()
+        # Extra sends of changed packets go at the front, as far as there's room
+        extra = []
+        for packet in boosted:
+            if size + len(packet) > self.chain.size:
+                break
+            extra.append(packet)
+            size += len(packet)
+        self._decay()
+        frame = b"".join(urgent + extra + regular + background)
+        if not frame:
+            frame = self._idle
+        return frame
+
+    # The background packets to send in this frame, moving them to the back
+    # of the queue. There's always another frame coming while any remain unsent
+    def _background_slice(self):
+        budget = self._size * PacketScheduler.BACKGROUND_SHARE
+        chosen = []
+        size = 0
+        for (key, packet) in list(self._background.items()):
+            if chosen and size + len(packet) > budget:
+                break
+            chosen.append(packet)
+            size += len(packet)
+            self._background.move_to_end(key)
+        if len(chosen) < len(self._background):
+            self.chain.invalidate()
+        return chosen
+
+    def _decay(self):
+        for addr in list(self._boost):
+            self._boost[addr] -= 1
+            if self._boost[addr] == 0:
+                del self._boost[addr]
+        if self._boost:
+            # Another frame is needed, with fewer repeats in it
+            self.chain.invalidate()
+
+    # The longest a changed packet can take to reach the track, in seconds:
+    # the rest of the frame being streamed, then waiting for the buffer the
+    # next frame goes in to be released, then the packet itself
+    def max_latency(self):
+        return 2 * self.chain.size * 8 * self.chain.BIT_TIME
+
+    def __repr__(self):
+        return "PacketScheduler[addresses=%d,background=%d]" % (len(self._packets), len(self._background))
+
+    def _valid(self):
+        assert self.chain
+        assert self.chain.compose == self.frame
+        return True
+
+    @staticmethod
+    def unit_test():
+        print("unit testing PacketScheduler")
+        from app.models.refresh_chain import RefreshChain
+        scheduler = PacketScheduler(RefreshChain(256, 0))
+        idle = dcclib.to_dma_bytes(dcclib.idle_instruction())
+        stop = dcclib.to_dma_bytes(dcclib.stop_instruction(True))
+        a = dcclib.to_dma_bytes(dcclib.speed_instruction(3, True, 5))
+        b = dcclib.to_dma_bytes(dcclib.speed_instruction(4, True, 0))
+        with scheduler.lock:
+            assert scheduler.frame() == idle
+            scheduler.update(3, a)
+            assert scheduler.frame() == a + a
+            assert scheduler.frame() == a + a
+            assert scheduler.frame() == a + a
+            assert scheduler.frame() == a
+            scheduler.update(4, b)
+            scheduler.send_now(stop, 2)
+            assert scheduler.frame() == stop + stop + b + a + b
+            assert scheduler.frame() == b + a + b
+            scheduler.stop()
+            assert scheduler.frame() == stop * PacketScheduler.URGENT_REPEATS
+            scheduler.update(3, b)
+            assert scheduler.frame() == stop * PacketScheduler.URGENT_REPEATS
+            scheduler.resume()
+            assert scheduler.frame() == b + b + b + b
+            scheduler.update(3, a)
+            scheduler.remove(3)
+            scheduler.remove(4)
+            assert scheduler.frame() == idle
+            # Addresses that don't fit are refused, not left out of the frame
+            for addr in range(3, 3 + 128 // len(a)):
+                scheduler.update(addr, a)
+            assert not scheduler.has_room(len(a))
+            try:
+                scheduler.update(100, a)
+                assert False, "Too many addresses accepted"
+            except TooManyAddresses:
+                pass
+            for addr in range(3, 3 + 128 // len(a)):
+                scheduler.remove(addr)
+            scheduler.frame()
+            assert scheduler.frame() == idle
+            assert scheduler._size == 0
+            # Urgent packets that don't fit wait for the next frame
+            for i in range(9):
+                scheduler.send_now(stop, 2)
+            assert scheduler.frame() == stop * 16
+            assert scheduler.frame() == stop * 2
+            # Background packets are sent a few at a time, after the regular ones
+            f = [dcclib.to_dma_bytes(dcclib.function_instruction(3, group, 1)) for group in range(3)]
+            scheduler.update(3, a)
+            for group in range(3):
+                scheduler.update_background((3, group), f[group])
+            frames = [scheduler.frame() for i in range(6)]
+            # Changed packets are boosted, background or not
+            assert frames[0] == a + f[0] + f[1] + f[2] + a + f[0]
+            assert frames[1] == a + f[0] + f[1] + f[2] + a + f[1]
+            assert frames[3] == a + f[0]
+            assert frames[4] == a + f[1]
+            assert frames[5] == a + f[2]
+            scheduler.remove(3)
+            for group in range(3):
+                scheduler.remove_background((3, group))
+            assert scheduler.frame() == idle
@@ -0,0 +1,188 @@
+# DCC - Digital Command Control command station
+# Copyright (C) 2018 Simon Howkins
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# Source for this program is published at https://github.com/simonhowkins/dcc
+
+"""Refresh chain model
+
+A set of DMA buffers that take turns to be streamed to the track.
+
+Writers poke into a draft frame, which is held in ordinary memory (or a
+compose function builds each frame on demand). A publisher thread copies
+the frame into a DMA buffer that isn't being
+streamed, makes that buffer loop on itself, and then points the live
+buffer's next control block at it. The DMA engine finishes its pass over
+the old buffer and moves on to the new one, so it never sees a half
+written packet."""
+
+import threading
+import time
+from ctypes import addressof
+
+from app.models.dma_buffer import DmaBuffer
+
+class RefreshChain(object):
+    # Class constants:
+    # Seconds taken to transmit each bit of a DMA buffer (ie a DCC half-bit)
+    BIT_TIME = 58e-6
+
+    # Writers can hold lock across several pokes, to have them published together
+    # compose, if given, is called (with lock held) to build each frame,
+    # instead of publishing the draft
+    # memory, if given, is a DmaMemory to allocate the buffers from
+    def __init__(self, size, dest, depth=2, lock=None, compose=None, memory=None):
+        assert depth >= 2
+        # Instance attributes:
+        self.size = size
+        self.dest = dest
+        self.depth = depth
+        self._publishing = threading.Lock()
+        self._allocate(memory)
+
+        self.draft = bytearray(size)
+        self.compose = compose or (lambda: bytes(self.draft))
+        self.lock = lock or threading.RLock()
+        self.changed = threading.Condition(self.lock)
+        # Sequence numbers of the latest change to the draft, and the latest published
+        self.composed = 0
+        self.published = 0
+        # Functions called with each frame once it's published (with no lock
+        # held, on the publishing thread) - they must be quick
+        self.listeners = []
+        threading.Thread(target=self._publish_loop, name="refresh-chain", daemon=True).start()
+        assert self._valid()
+
+    def _allocate(self, memory):
+        self.memory = memory
+        self.buffers = [memory.allocate(self.size, self.dest) if memory else DmaBuffer(self.size, self.dest) for i in range(self.depth)]
+        for buffer in self.buffers:
+            # Nothing to stream until the first frame is published
+            buffer.header[3] = 0
+            buffer.set_next_buffer(buffer)
+        self.live = 0
+        # When (by time.monotonic()) each buffer is sure to have been left by the DMA engine
+        self.retiredAt = [0.0] * self.depth
+
+    # Move the buffers into a DmaMemory (eg mapped from a file, for other
+    # processes to read), and republish - only before streaming has started
+    def use_memory(self, memory):
+        with self._publishing:
+            self._allocate(memory)
+        self.invalidate()
+
+    # The buffer currently being streamed
+    @property
+    def front(self):
+        return self.buffers[self.live]
+
+    # Peek method - reads the draft, ie the latest state, published or not
+    def __getitem__(self, index):
+        assert self._valid()
+        value = self.draft[index]
+        return list(value) if isinstance(index, slice) else value
+
+    # Poke method - changes the draft, which will be published shortly
+    def __setitem__(self, index, value):
+        assert self._valid()
+        with self.lock:
+            self.draft[index] = value
+            self.invalidate()
+
+    # Note that the next frame will differ from the last one published
+    def invalidate(self):
+        with self.lock:
+            self.composed += 1
+            self.changed.notify_all()
+
+    # Wait until everything poked so far has been published
+    def flush(self, timeout=None):
+        with self.changed:
+            target = self.composed
+            return self.changed.wait_for(lambda: self.published >= target, timeout)
+
+    # Seconds taken to stream the given buffer once
+    def frame_time(self, buffer):
+        return buffer.header[3] * 8 * RefreshChain.BIT_TIME
+
+    # Each frame is only composed once there's a buffer free to put it in, so
+    # it's as fresh as it can be - a change made while waiting for the buffer
+    # (eg an emergency stop) never queues up behind a frame made before it
+    def _publish_loop(self):
+        while True:
+            with self.changed:
+                self.changed.wait_for(lambda: self.published != self.composed)
+            with self._publishing:
+                # Don't touch the buffer until the DMA engine has moved off it
+                back = (self.live + 1) % len(self.buffers)
+                time.sleep(max(0, self.retiredAt[back] - time.monotonic()))
+                with self.changed:
+                    sequence = self.composed
+                    frame = self.compose()
+                    assert len(frame) <= self.size
+                self._publish(frame)
+            with self.changed:
+                self.published = sequence
+                self.changed.notify_all()
+            for listener in self.listeners:
+                listener(frame)
+
+    # Must be called with _publishing held, once the back buffer has retired
+    def _publish(self, frame):
+        back = (self.live + 1) % len(self.buffers)
+        buffer = self.buffers[back]
+        buffer.view()[0:len(frame)] = frame
+        buffer.header[3] = len(frame)
+        buffer.set_next_buffer(buffer)
+        # The flip - from the end of its current pass, the DMA engine streams the new buffer
+        self.front.set_next_buffer(buffer)
+        self.retiredAt[self.live] = time.monotonic() + self.frame_time(self.front)
+        self.live = back
+        if self.memory:
+            self.memory.publish(buffer)
+
+    def __repr__(self):
+        return "RefreshChain[size=%d,depth=%d]" % (self.size, len(self.buffers))
+
+    def _valid(self):
+        assert self.size > 0
+        assert len(self.draft) == self.size
+        assert 0 <= self.live < len(self.buffers)
+        return True
+
+    @staticmethod
+    def unit_test():
+        print("unit testing RefreshChain")
+        chain = RefreshChain(128, 0)
+        old = chain.front
+        with chain.lock:
+            chain[4:6] = [1, 2]
+            chain[6:8] = [3, 4]
+        assert chain[4:8] == [1, 2, 3, 4]
+        assert chain.flush(1)
+        assert chain.front is not old
+        assert chain.front[4:8] == [1, 2, 3, 4]
+        # Control block addresses are 32 bits, as seen by the DMA engine
+        assert old.header[5] == addressof(chain.front.header) & 0xFFFFFFFF
+        assert chain.front.header[5] == addressof(chain.front.header) & 0xFFFFFFFF
+        # Published frames can be read from the mapped memory, eg by another process
+        import os.path
+        import tempfile
+        from app.models.dma_buffer import DmaMemory
+        path = os.path.join(tempfile.mkdtemp(), "dma")
+        chain.use_memory(DmaMemory(path, DmaMemory.size_for(128, 128)))
+        assert chain.flush(1)
+        assert chain.front.offset in [32, 192]
+        assert DmaMemory(path, readonly=True).live()[1].tobytes() == bytes(chain.draft)
@@ -0,0 +1,120 @@
+# DCC - Digital Command Control command station
+# Copyright (C) 2018 Simon Howkins
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# Source for this program is published at https://github.com/simonhowkins/dcc
+
+"""Roster model
+
+An in-process copy of the Engine table, indexed by id and by address, so
+pages can be rendered without going to the database. It's thrown away
+whenever a transaction that changed an Engine commits, and reloaded the
+next time it's needed"""
+
+import threading
+from collections import namedtuple
+
+from sqlalchemy import event
+
+from app.models.engine import Engine
+from app.services import dcclib
+
+# A read-only snapshot of an Engine row
+# speedCurve is parsed, as Engine.parse_curve, and speedSteps falls back to
+# 28 if what's stored isn't a mode dcclib can encode
+EngineRecord = namedtuple("EngineRecord", ["id", "nickname", "addr", "maxSpeed", "acceleration", "braking", "speedSteps", "speedCurve", "consist", "consistReversed"])
+
+class Roster(object):
+
+    def __init__(self):
+        # Instance attributes:
+        self._lock = threading.Lock()
+        self._engines = None
+        self._byId = {}
+        self._byAddr = {}
+        self._byConsist = {}
+        self.loads = 0
+
+    # Invalidate the roster whenever a session made by sessionFactory
+    # commits changes to any Engine
+    def watch(self, sessionFactory):
+        def after_flush(session, flush_context):
+            if any(isinstance(o, Engine) for o in list(session.new) + list(session.dirty) + list(session.deleted)):
+                session.info["rosterChanged"] = True
+
+        def after_commit(session):
+            if session.info.pop("rosterChanged", False):
+                self.invalidate()
+
+        def after_rollback(session):
+            session.info.pop("rosterChanged", None)
+
+        event.listen(sessionFactory, "after_flush", after_flush)
+        event.listen(sessionFactory, "after_commit", after_commit)
+        event.listen(sessionFactory, "after_rollback", after_rollback)
+
+    def invalidate(self):
+        with self._lock:
+            self._engines = None
+
+    # All the engines, in id order
+    def engines(self, dbSession):
+        engines = self._engines
+        if engines is None:
+            engines = self._load(dbSession)
+        return engines
+
+    def by_id(self, dbSession, id):
+        self.engines(dbSession)
+        return self._byId.get(int(id))
+
+    def by_addr(self, dbSession, addr):
+        self.engines(dbSession)
+        return self._byAddr.get(int(addr))
+
+    # The engines driven along with an engine (which must have an address),
+    # in id order, so the first is the lead - just the engine itself if it's
+    # not in a consist
+    def consist(self, dbSession, engine):
+        self.engines(dbSession)
+        return self._byConsist.get(engine.consist) or [engine]
+
+    # Every consist, as a list of [(addr, reversed)], lead first, where
+    # reversed is relative to the lead - as DccChannel.reconsist takes
+    def consists(self, dbSession):
+        self.engines(dbSession)
+        return [[(int(e.addr), e.consistReversed != engines[0].consistReversed) for e in engines]
+            for engines in self._byConsist.values()]
+
+    def _load(self, dbSession):
+        with self._lock:
+            if self._engines is None:
+                engines = [EngineRecord(e.id, e.nickname, e.addr, e.maxSpeed, e.acceleration, e.braking, e.speedSteps if e.speedSteps in dcclib.SPEED_STEPS else 28, Engine.parse_curve(e.speedCurve), (e.consist or "").strip(), bool(e.consistReversed))
+                    for e in dbSession.query(Engine).order_by(Engine.id)]
+                self._byId = {e.id: e for e in engines}
+                self._byAddr = {int(e.addr): e for e in engines if e.addr}
+                byConsist = {}
+                for e in engines:
+                    if e.consist and e.addr:
+                        byConsist.setdefault(e.consist, []).append(e)
+                self._byConsist = byConsist
+                self._engines = engines
+                self.loads += 1
+            return self._engines
+
+    def __repr__(self):
+        return "Roster[engines=%s]" % (len(self._engines) if self._engines is not None else "?")
+
+roster = Roster()
@@ -0,0 +1,107 @@
+# DCC - Digital Command Control command station
+# Copyright (C) 2018 Simon Howkins
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# Source for this program is published at https://github.com/simonhowkins/dcc
+
+"""State journal model
+
+An append-only file of channel state changes, so the state of every
+channel can be restored when the command station restarts.
+
+Changes are only noted in memory by the thread making them (so journaling
+never slows down a request). A background thread writes them out in
+batches, keeping just the latest state of each channel in a batch. The
+file is compacted down to one record per moving channel whenever it's
+restored - stopped channels are left out, so they don't go back into the
+refresh stream after every restart"""
+
+import os.path
+import struct
+
+from app.services.batched_appender import BatchedAppender
+
+class StateJournal(object):
+    # Class constants:
+    # Each record is addr, throttle, speed, forwards
+    RECORD = struct.Struct("<HBBB")
+    # Seconds between writes to the file
+    INTERVAL = 0.5
+
+    def __init__(self, path, interval=INTERVAL):
+        # Instance attributes:
+        self.path = path
+        self._appender = BatchedAppender(path, StateJournal._encode, interval, name="state-journal")
+
+    # Number of records written to the file
+    @property
+    def records(self):
+        return self._appender.records
+
+    # Note the state of a channel - cheap, and never waits for the file
+    def record(self, addr, throttle, speed, forwards):
+        self._appender.add((addr, throttle, speed, forwards), key=addr)
+
+    # Read the latest state of every moving channel (or one with its throttle
+    # open) from the file, as a dict of addr: (throttle, speed, forwards),
+    # and compact the file down to them
+    def restore(self):
+        states = {}
+        if os.path.exists(self.path):
+            with open(self.path, "rb") as f:
+                data = f.read()
+            # Ignore any partly written record at the end
+            usable = len(data) - len(data) % StateJournal.RECORD.size
+            for (addr, throttle, speed, forwards) in StateJournal.RECORD.iter_unpack(data[:usable]):
+                states[addr] = (throttle, speed, forwards == 1)
+        states = {addr: state for (addr, state) in states.items() if state[:2] != (0, 0)}
+        self._appender.rewrite(b"".join(StateJournal._pack(addr, *state) for (addr, state) in sorted(states.items())))
+        return states
+
+    # Write out anything pending, now
+    def flush(self):
+        self._appender.flush()
+
+    @staticmethod
+    def _encode(batch):
+        return b"".join(StateJournal._pack(*record) for record in batch)
+
+    @staticmethod
+    def _pack(addr, throttle, speed, forwards):
+        return StateJournal.RECORD.pack(addr, throttle, speed, 1 if forwards else 0)
+
+    def __repr__(self):
+        return "StateJournal[path=%s]" % (self.path)
+
+    @staticmethod
+    def unit_test():
+        print("unit testing StateJournal")
+        import tempfile
+        path = os.path.join(tempfile.mkdtemp(), "test.journal")
+        journal = StateJournal(path, interval=60)
+        assert journal.restore() == {}
+        journal.record(3, 10, 4, True)
+        journal.record(3, 10, 5, True)
+        journal.record(4000, 2, 0, False)
+        journal.record(5, 0, 0, False)
+        journal.flush()
+        assert journal.records == 3
+        journal.record(3, 0, 5, True)
+        journal.flush()
+        with open(path, "ab") as f:
+            f.write(b"\x03\x00")
+        # Stopped channels are dropped
+        assert journal.restore() == {3: (0, 5, True), 4000: (2, 0, False)}
+        assert os.path.getsize(path) == 2 * StateJournal.RECORD.size
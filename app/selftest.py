@@ -0,0 +1,72 @@
+# DCC - Digital Command Control command station
+# Copyright (C) 2018 Simon Howkins
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# Source for this program is published at https://github.com/simonhowkins/dcc
+
+"""Self tests
+
+Runs the unit tests of every module. These are too slow to run every time
+the command station starts, so they're run by `python -m app --selftest`.
+If the selftest setting is true, the isolated ones are run at startup too"""
+
+import time
+
+import app.services.batched_appender
+import app.services.command_trace
+import app.services.dcclib
+import app.services.metrics
+import app.services.track_simulator
+import app.asgi
+import app.models.dcc_channel
+from app.models.dma_buffer import DmaBuffer, DmaMemory
+from app.models.refresh_chain import RefreshChain
+from app.models.packet_scheduler import PacketScheduler
+from app.models.state_journal import StateJournal
+
+# Tests that only use objects of their own, so are safe to run in the command
+# station at startup
+isolatedTests = [
+    ("dcclib", app.services.dcclib.unit_test),
+    ("DmaBuffer", DmaBuffer.unit_test),
+    ("DmaMemory", DmaMemory.unit_test),
+    ("RefreshChain", RefreshChain.unit_test),
+    ("PacketScheduler", PacketScheduler.unit_test),
+    ("BatchedAppender", app.services.batched_appender.unit_test),
+    ("StateJournal", StateJournal.unit_test),
+    ("TrackSimulator", app.services.track_simulator.unit_test),
+]
+
+# Tests that drive the live channels and run buffer (eg with emergency stops),
+# so are only run by python -m app --selftest
+channelTests = [
+    ("DccChannel", app.models.dcc_channel.unit_test),
+    ("ChannelStress", app.models.dcc_channel.stress_test),
+    ("metrics", app.services.metrics.unit_test),
+    ("CommandTrace", app.services.command_trace.unit_test),
+    ("AsgiApp", app.asgi.unit_test),
+]
+
+tests = isolatedTests + channelTests
+
+# Run the unit tests (all of them by default), returning how long (in
+# seconds) each one took
+def run(tests=tests):
+    timings = []
+    for (name, test) in tests:
+        start = time.perf_counter()
+        test()
+        timings.append((name, time.perf_counter() - start))
+    return timings
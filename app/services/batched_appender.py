@@ -0,0 +1,151 @@
+# DCC - Digital Command Control command station
+# Copyright (C) 2018 Simon Howkins
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# Source for this program is published at https://github.com/simonhowkins/dcc
+
+"""Batched appender service
+
+Appends records to a file in batches, from a background thread, so the
+threads making the records never wait for the file - however slow the disk
+(eg an SD card).
+
+Adding a record only holds a lock long enough to put it in a dict. The
+writer swaps the whole batch out under that lock, then encodes and writes
+it with only a separate I/O lock held, which also keeps flush() and any
+rewrite of the file in order with the writer"""
+
+import itertools
+import os
+import threading
+
+class BatchedAppender(object):
+
+    # encode is called with each batch, as a list of records in the order
+    # they were added, and returns the bytes to append (it's only ever called
+    # by one thread at a time)
+    def __init__(self, path, encode, interval, name="batched-appender"):
+        # Instance attributes:
+        self.path = path
+        self.encode = encode
+        self.interval = interval
+        self.records = 0
+        # Records not yet written, by key - a later record with the same key
+        # replaces the pending one
+        self._pending = {}
+        self._serial = itertools.count()
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        # Held while writing, and by anything else that touches the file
+        self._io = threading.Lock()
+        self._file = None
+        self._closed = False
+        threading.Thread(target=self._write_loop, name=name, daemon=True).start()
+
+    # Add a record - cheap, and never waits for the file
+    def add(self, record, key=None):
+        with self._lock:
+            self._pending[next(self._serial) if key is None else key] = record
+            self._changed.notify()
+
+    # Write out anything pending, now
+    def flush(self):
+        with self._io:
+            self._write()
+
+    # Replace the whole file with data, eg to compact it, once anything
+    # pending has been written
+    def rewrite(self, data):
+        with self._io:
+            self._write()
+            self._closeFile()
+            temporary = self.path + ".new"
+            with open(temporary, "wb") as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temporary, self.path)
+
+    def close(self):
+        with self._io:
+            self._write()
+            self._closeFile()
+            self._closed = True
+        with self._lock:
+            self._changed.notify()
+
+    def _write_loop(self):
+        while True:
+            with self._changed:
+                self._changed.wait_for(lambda: self._pending or self._closed)
+            with self._io:
+                if self._closed:
+                    return
+                self._write()
+            # Let more records accumulate, so they're written together
+            threading.Event().wait(self.interval)
+
+    # Must be called with _io held
+    def _write(self):
+        with self._lock:
+            batch = list(self._pending.values())
+            self._pending = {}
+        if not batch or self._closed:
+            return
+        if self._file is None:
+            self._file = open(self.path, "ab")
+        self._file.write(self.encode(batch))
+        self._file.flush()
+        self.records += len(batch)
+
+    def _closeFile(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def __repr__(self):
+        return "BatchedAppender[path=%s]" % (self.path)
+
+def unit_test():
+    print("unit testing BatchedAppender")
+    import os.path
+    import tempfile
+    path = os.path.join(tempfile.mkdtemp(), "test.log")
+    writing = threading.Event()
+    release = threading.Event()
+
+    # An encoder that stalls, like a slow disk
+    def encode(batch):
+        writing.set()
+        release.wait(5)
+        return b"".join(batch)
+
+    appender = BatchedAppender(path, encode, interval=60)
+    appender.add(b"a")
+    assert writing.wait(5)
+    # Records can still be added while a batch is being written
+    started = threading.Event()
+    threading.Thread(target=lambda: (appender.add(b"b", key=1), appender.add(b"c", key=1), started.set())).start()
+    assert started.wait(1)
+    release.set()
+    appender.flush()
+    assert appender.records == 2
+    with open(path, "rb") as f:
+        assert f.read() == b"ac"
+    appender.rewrite(b"xyz")
+    appender.add(b"d")
+    appender.close()
+    with open(path, "rb") as f:
+        assert f.read() == b"xyzd"
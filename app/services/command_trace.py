@@ -0,0 +1,342 @@
+# DCC - Digital Command Control command station
+# Copyright (C) 2018 Simon Howkins
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# Source for this program is published at https://github.com/simonhowkins/dcc
+
+"""Command trace service
+
+Records everything the cabs and the shed ask the command station to do, and
+every frame published to the run buffer, in a compact binary file, so an
+operating session can be replayed afterwards - at the speed it happened, or
+as fast as possible - eg to reproduce a fault, or as a benchmark.
+
+Recording only notes each record in memory (so it never slows down a
+request, or the publishing of a frame); a BatchedAppender diffs and writes
+them out in batches. Frames are
+written as the difference from the previous frame.
+
+Each record is a header - time since the session started (in ticks of
+100us), type, payload length - then the payload. A file can hold several
+sessions, one after the other, each starting with a SESSION record"""
+
+import json
+import os
+import os.path
+import struct
+import time
+
+from app.services import dcclib
+from app.services.batched_appender import BatchedAppender
+
+# Record header: time in ticks, type, payload length
+HEADER = struct.Struct("<IcH")
+TICK = 1e-4
+
+# Record types, and the layout of their payloads
+SESSION = b"T"      # Wall clock time the session started (double)
+UPDATE = b"C"       # addr, throttle (255 for no change), direction (0 for no change)
+FUNCTION = b"F"     # addr, function number, on
+STOP = b"S"         # (emergency stop - no payload)
+DRIVE = b"D"        # JSON list of DccChannel.configure's arguments
+SHED = b"E"         # JSON list of the action and the engine's fields
+FRAME = b"B"        # new length, unchanged prefix, unchanged suffix, then the changed bytes
+
+PAYLOADS = {
+    SESSION: struct.Struct("<d"),
+    UPDATE: struct.Struct("<HBb"),
+    FUNCTION: struct.Struct("<HBB"),
+    FRAME: struct.Struct("<HHH"),
+}
+
+class CommandTrace(object):
+    # Class constants:
+    # Seconds between writes to the file
+    INTERVAL = 0.5
+
+    def __init__(self, path, interval=INTERVAL):
+        # Instance attributes:
+        self.path = path
+        self.start = time.monotonic()
+        # The last frame written, which the next one is written relative to
+        self._frame = b""
+        # Drop any partly written record at the end, so this session follows on
+        if os.path.exists(path):
+            os.truncate(path, _usable(path))
+        self._appender = BatchedAppender(path, self._encode, interval, name="command-trace")
+        self._note(SESSION, PAYLOADS[SESSION].pack(time.time()))
+
+    # Number of records written to the file
+    @property
+    def records(self):
+        return self._appender.records
+
+    # Note a cab or shed command - cheap, and never waits for the file
+    # (see record() for the kinds of command)
+    def note(self, kind, *args):
+        if kind == "update":
+            (addr, throttle, direction) = args
+            self._note(UPDATE, PAYLOADS[UPDATE].pack(addr, 255 if throttle is None else throttle, direction or 0))
+        elif kind == "function":
+            (addr, n, on) = args
+            self._note(FUNCTION, PAYLOADS[FUNCTION].pack(addr, n, 1 if on else 0))
+        elif kind == "stop":
+            self._note(STOP, b"")
+        elif kind == "drive":
+            self._note(DRIVE, json.dumps(args).encode())
+        elif kind == "shed":
+            self._note(SHED, json.dumps(args).encode())
+        else:
+            assert False, "Unknown command %s" % kind
+
+    # Note a frame published to the run buffer - a RefreshChain listener
+    def frame(self, frame):
+        self._note(FRAME, frame)
+
+    def _note(self, type, payload):
+        ticks = int((time.monotonic() - self.start) / TICK)
+        self._appender.add((ticks, type, payload))
+
+    # Write out anything pending, now
+    def flush(self):
+        self._appender.flush()
+
+    def close(self):
+        self._appender.close()
+
+    def _encode(self, batch):
+        chunks = []
+        for (ticks, type, payload) in batch:
+            if type == FRAME:
+                payload = self._diff(payload)
+            chunks.append(HEADER.pack(ticks, type, len(payload)))
+            chunks.append(payload)
+        return b"".join(chunks)
+
+    # A frame, as the difference from the last one
+    def _diff(self, frame):
+        old = self._frame
+        limit = min(len(old), len(frame))
+        prefix = 0
+        while prefix < limit and old[prefix] == frame[prefix]:
+            prefix += 1
+        suffix = 0
+        while suffix < limit - prefix and old[-1 - suffix] == frame[-1 - suffix]:
+            suffix += 1
+        self._frame = frame
+        return PAYLOADS[FRAME].pack(len(frame), prefix, suffix) + frame[prefix:len(frame) - suffix]
+
+    def __repr__(self):
+        return "CommandTrace[path=%s]" % (self.path)
+
+# The length of the whole records at the start of a trace file
+def _usable(path):
+    with open(path, "rb") as f:
+        data = f.read()
+    pos = 0
+    while pos + HEADER.size <= len(data):
+        (ticks, type, length) = HEADER.unpack_from(data, pos)
+        if pos + HEADER.size + length > len(data):
+            break
+        pos += HEADER.size + length
+    return pos
+
+# The trace being recorded, if any
+recorder = None
+
+# Record a command, if a trace is being recorded:
+# * "update", addr, throttle, direction - None for no change
+# * "function", addr, function number, on
+# * "stop"
+# * "drive", the arguments of DccChannel.configure
+# * "shed", action, the engine's fields (as a dict)
+def record(kind, *args):
+    if recorder is not None:
+        recorder.note(kind, *args)
+
+# Read a trace, as (time, type, args) for every record, where time is in
+# seconds from the start of the first session, and args are as record(),
+# or the whole frame for a FRAME
+def read(path):
+    with open(path, "rb") as f:
+        data = f.read()
+    pos = 0
+    base = 0.0
+    last = 0.0
+    frame = b""
+    while pos + HEADER.size <= len(data):
+        (ticks, type, length) = HEADER.unpack_from(data, pos)
+        payload = data[pos + HEADER.size:pos + HEADER.size + length]
+        if len(payload) < length:
+            # A partly written record at the end
+            break
+        pos += HEADER.size + length
+        if type == SESSION:
+            # Sessions follow on from each other
+            base = last
+        when = last = base + ticks * TICK
+        if type == FRAME:
+            (size, prefix, suffix) = PAYLOADS[FRAME].unpack_from(payload)
+            frame = frame[:prefix] + payload[PAYLOADS[FRAME].size:] + frame[len(frame) - suffix:]
+            assert len(frame) == size, "Frame at %.4fs doesn't follow on from the one before" % when
+            args = frame
+        elif type in PAYLOADS:
+            args = PAYLOADS[type].unpack(payload)
+            if type == UPDATE:
+                (addr, throttle, direction) = args
+                args = (addr, None if throttle == 255 else throttle, direction or None)
+        elif type in [DRIVE, SHED]:
+            args = tuple(json.loads(payload.decode()))
+        else:
+            args = ()
+        yield (when, type, args)
+
+# The SPEED instructions in a frame, by address
+def _speeds(frame):
+    return {addr: args for (addr, instType, args) in dcclib.decode_many(frame) if instType in ["SPEED", "SPEED128"]}
+
+# Drive a trace back through DccChannel, as fast as possible, or at speedup
+# times the speed it was recorded at. Speed ramping runs in trace time, so
+# the replay matches the recording whatever the speed
+# Returns a report, including any addresses whose speed at the end of the
+# replay doesn't match the last frame recorded
+def replay(path, speedup=None):
+    from app.models.dcc_channel import DccChannel
+    counts = {}
+    errors = []
+    recordedFrame = b""
+    clock = 0.0
+    wallStart = time.monotonic()
+    with DccChannel._rampCondition:
+        DccChannel.manualRamping = True
+
+    # Run the ramping, and keep to time, up to the given trace time
+    def advance(until):
+        nonlocal clock
+        while clock + DccChannel.RAMP_INTERVAL <= until:
+            if not DccChannel._ramping:
+                clock = until
+                break
+            clock += DccChannel.RAMP_INTERVAL
+            DccChannel._adjustSpeeds(DccChannel.RAMP_INTERVAL)
+        if speedup:
+            time.sleep(max(0.0, wallStart + until / speedup - time.monotonic()))
+
+    try:
+        for (when, type, args) in read(path):
+            advance(when)
+            counts[type] = counts.get(type, 0) + 1
+            try:
+                if type == UPDATE:
+                    (addr, throttle, direction) = args
+                    channel = DccChannel(addr)
+                    if throttle is not None:
+                        channel.throttle = throttle
+                    if direction is not None:
+                        channel.direction = direction
+                elif type == FUNCTION:
+                    (addr, n, on) = args
+                    DccChannel(addr).set_function(n, on)
+                elif type == STOP:
+                    DccChannel.emergency_stop(wait=False)
+                elif type == DRIVE:
+                    DccChannel.configure(*args)
+                elif type == FRAME:
+                    recordedFrame = args
+            except (AssertionError, ValueError, KeyError) as e:
+                errors.append((when, type.decode(), str(e)))
+        # Let ramping finish, as it would have after the recording ended
+        advance(clock + 60)
+    finally:
+        with DccChannel._rampCondition:
+            DccChannel.manualRamping = False
+            DccChannel._rampCondition.notify_all()
+    elapsed = time.monotonic() - wallStart
+    assert DccChannel.run_buffer.flush(2 * DccChannel.packets.max_latency()), "Run buffer not published"
+    with DccChannel.lock:
+        replayed = _speeds(DccChannel.run_buffer.front.frame())
+    recorded = _speeds(recordedFrame) if recordedFrame else replayed
+    return {
+        "traceTime": clock,
+        "elapsed": elapsed,
+        "commands": sum(counts.get(type, 0) for type in [UPDATE, FUNCTION, STOP, DRIVE]),
+        "shedChanges": counts.get(SHED, 0),
+        "frames": counts.get(FRAME, 0),
+        "sessions": counts.get(SESSION, 0),
+        "errors": errors,
+        "mismatches": sorted(addr for addr in set(recorded) | set(replayed) if recorded.get(addr) != replayed.get(addr)),
+    }
+
+def unit_test():
+    print("unit testing CommandTrace")
+    import tempfile
+    path = os.path.join(tempfile.mkdtemp(), "test.trace")
+    trace = CommandTrace(path, interval=60)
+    trace.note("update", 3, 10, None)
+    trace.note("update", 3, None, -1)
+    trace.note("function", 3, 21, True)
+    trace.note("drive", 3, 50, 100, [[3, 128, [10, 100], False]])
+    trace.note("shed", "save", {"id": 1, "nickname": "Loco"})
+    a = dcclib.to_dma_bytes(dcclib.speed_instruction(3, True, 5))
+    b = dcclib.to_dma_bytes(dcclib.speed_instruction(4, False, 6))
+    for frame in [a, a + b, b, b]:
+        trace.frame(frame)
+    trace.note("stop")
+    trace.close()
+    # Changed frames only take up as much room as the change
+    assert trace._diff(b) == PAYLOADS[FRAME].pack(len(b), len(b), 0)
+    assert trace._diff(b + a) == PAYLOADS[FRAME].pack(len(a + b), len(b), 0) + a
+    with open(path, "ab") as f:
+        f.write(HEADER.pack(0, UPDATE, 4) + b"\x03")
+    records = list(read(path))
+    times = [when for (when, type, args) in records]
+    assert times == sorted(times)
+    assert [(type, args) for (when, type, args) in records if type != FRAME] == [
+        (SESSION, (records[0][2][0],)),
+        (UPDATE, (3, 10, None)),
+        (UPDATE, (3, None, -1)),
+        (FUNCTION, (3, 21, 1)),
+        (DRIVE, (3, 50, 100, [[3, 128, [10, 100], False]])),
+        (SHED, ("save", {"id": 1, "nickname": "Loco"})),
+        (STOP, ()),
+    ]
+    assert [args for (when, type, args) in records if type == FRAME] == [a, a + b, b, b]
+
+    # A second session carries on from the first, in trace time
+    trace = CommandTrace(path, interval=60)
+    trace.note("update", 3, 0, None)
+    trace.close()
+    records = list(read(path))
+    assert [type for (when, type, args) in records].count(SESSION) == 2
+    assert records[-1][0] >= times[-1]
+
+    # Replaying runs the ramping in trace time, however fast it goes
+    from app.models.dcc_channel import DccChannel
+    path = os.path.join(os.path.dirname(path), "replay.trace")
+    trace = CommandTrace(path, interval=60)
+    trace.note("drive", 15, 20, 100, [[15, 28, None, False], [16, 28, None, True]])
+    trace.note("update", 15, 5, None)
+    trace.note("update", 15, 99, None)
+    trace.close()
+    report = replay(path)
+    assert report["commands"] == 3
+    assert [type for (when, type, error) in report["errors"]] == ["C"]
+    assert report["mismatches"] == []
+    assert (DccChannel(15).speed, DccChannel(16).speed, DccChannel(16).direction) == (5, 5, DccChannel.BACKWARDS)
+    assert not DccChannel.manualRamping
+    DccChannel(15).throttle = 0
+    DccChannel(15).speed = 0
+    DccChannel(15).set_consist([])
+    DccChannel(16).direction = DccChannel.FORWARDS
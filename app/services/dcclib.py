@@ -28,18 +28,32 @@ And the reverse of the above
 """
 
 import functools
-from collections import deque
+import itertools
+import threading
+from collections import OrderedDict, deque
 
-# Build a speed instruction
-def speed_instruction(addr, forwards, speed):
+import numpy
+
+# Short addresses take one byte, long (14-bit) addresses take two
+MAX_SHORT_ADDR = 127
+MAX_LONG_ADDR = 10239
+
+# Build the address bytes at the start of an instruction
+def address_bytes(addr):
     assert addr > 0
-#    assert addr < 100
+    assert addr <= MAX_LONG_ADDR
+    if addr <= MAX_SHORT_ADDR:
+        return [addr]
+    return [0xC0 + (addr >> 8), addr & 0xFF]
+
+# Build a speed instruction (28 speed step mode): 01DC SSSS
+def speed_instruction(addr, forwards, speed):
     assert forwards == True or forwards == False
     assert speed >= 0
     assert speed <= 28
-    speed_byte = 0x20
+    speed_byte = 0x40
     if forwards:
-        speed_byte += 0x40
+        speed_byte += 0x20
     # Avoid the special Emergency Stop values
     if speed != 0:
         speed += 3
@@ -47,7 +61,89 @@ def speed_instruction(addr, forwards, speed):
     speed_byte += (speed & 1) << 4
     speed_byte += (speed >> 1)
 
-    return [addr, speed_byte]
+    return address_bytes(addr) + [speed_byte]
+
+# The speed step modes, and the top speed step in each
+SPEED_STEPS = {28: 28, 128: 126}
+
+# Build an advanced operations speed instruction (128 speed step mode):
+# 0011 1111, then D SSSSSSS
+def speed128_instruction(addr, forwards, speed):
+    assert forwards == True or forwards == False
+    assert speed >= 0
+    assert speed <= 126
+    # Avoid the special Emergency Stop value
+    if speed != 0:
+        speed += 1
+    return address_bytes(addr) + [0x3F, (0x80 if forwards else 0) + speed]
+
+# Build the speed instruction for a speed step mode
+def speed_step_instruction(addr, forwards, speed, steps):
+    if steps == 128:
+        return speed128_instruction(addr, forwards, speed)
+    assert steps == 28
+    return speed_instruction(addr, forwards, speed)
+
+# Work out the speed step to send at each throttle notch (0 to notches)
+# curve is a list of percentages of top speed, at evenly spaced notches from
+# the first to the last - eg [10, 100] for a decoder that needs a kick to
+# start moving - or None for a straight line from stopped to top speed
+# The table never slows down as the throttle goes up, and only stops at notch 0
+# In 128 step mode the throttle still has only 28 notches - the table places
+# them more precisely on the curve, but there are no speeds in between
+def speed_table(steps, curve=None, notches=28):
+    top = SPEED_STEPS[steps]
+    table = [0]
+    for notch in range(1, notches + 1):
+        if not curve:
+            percent = 100 * notch / notches
+        elif len(curve) == 1:
+            percent = curve[0]
+        else:
+            # Interpolate between the nearest two points
+            position = (notch - 1) * (len(curve) - 1) / (notches - 1)
+            i = min(int(position), len(curve) - 2)
+            percent = curve[i] + (curve[i + 1] - curve[i]) * (position - i)
+        table.append(max(table[-1], 1, min(top, int(round(top * percent / 100)))))
+    return table
+
+# Loco functions F0-F28 are sent in groups, each as its own instruction
+# A set of functions is a bitfield, with bit n set if function Fn is on
+# Each group is (first function, last function, instruction bytes before the data)
+FUNCTION_GROUPS = [
+    (0, 4, []),         # Function group one: 100 F0 F4 F3 F2 F1
+    (5, 8, []),         # Function group two: 1011 F8 F7 F6 F5
+    (9, 12, []),        # Function group two: 1010 F12 F11 F10 F9
+    (13, 20, [0xDE]),   # Feature expansion: F13-F20 in the next byte
+    (21, 28, [0xDF]),   # Feature expansion: F21-F28 in the next byte
+]
+MAX_FUNCTION = 28
+
+# The functions in each group, as a bitfield
+def function_group_mask(group):
+    (first, last, prefix) = FUNCTION_GROUPS[group]
+    return ((1 << (last - first + 1)) - 1) << first
+
+# The group that function Fn is sent in
+def function_group(n):
+    assert 0 <= n <= MAX_FUNCTION
+    return next(group for (group, (first, last, prefix)) in enumerate(FUNCTION_GROUPS) if first <= n <= last)
+
+# Build the instruction that sets the functions in one group, from a
+# bitfield of all the functions (functions outside the group are ignored)
+def function_instruction(addr, group, functions):
+    (first, last, prefix) = FUNCTION_GROUPS[group]
+    bits = (functions >> first) & ((1 << (last - first + 1)) - 1)
+    if group == 0:
+        # F0 (the headlights) is the odd one out, in bit 4
+        data = [0x80 + ((bits & 1) << 4) + (bits >> 1)]
+    elif group == 1:
+        data = [0xB0 + bits]
+    elif group == 2:
+        data = [0xA0 + bits]
+    else:
+        data = prefix + [bits]
+    return address_bytes(addr) + data
 
 def idle_instruction():
     return [0xFF, 0]
@@ -106,6 +202,53 @@ def to_byte(bits):
 def to_bytes(bits):
     return [to_byte(bits[i:i + 8]) for i in range(0, len(bits), 8)]
 
+# Precomputed encodings, used to go straight from an instruction to the bytes
+# that would come out of to_bytes(round_up(to_signal(to_stream(instruction))))
+# Each signal is a (bits, length) pair: the signal bits packed into an integer, MSB first
+def _signal_of(stream):
+    bits = 0
+    length = 0
+    for b in stream:
+        (signal, signal_length) = (0b10, 2) if b else (0b1100, 4)
+        bits = (bits << signal_length) | signal
+        length += signal_length
+    return (bits, length)
+
+# The preamble followed by the first byte of the packet, for every byte value
+_FIRST_BYTE_SIGNAL = [_signal_of([1] * 13 + [0] + to_binary_array(value)) for value in range(256)]
+# A byte (with its leading zero bit), for every byte value
+_BYTE_SIGNAL = [_signal_of([0] + to_binary_array(value)) for value in range(256)]
+# The checksum byte followed by the packet end bit, for every byte value
+_LAST_BYTE_SIGNAL = [_signal_of([0] + to_binary_array(value) + [1]) for value in range(256)]
+# Padding to round a signal up to a multiple of 32 bits, indexed by the number of bits needed
+_PADDING_SIGNAL = [_signal_of([0] * (bits >> 2))[0] for bits in range(32)]
+
+# Convert an instruction straight into the bytes to put in memory to be transmitted
+# Equivalent to to_bytes(round_up(to_signal(to_stream(instruction)))), but much faster
+def to_dma_bytes(instruction):
+    if len(instruction) == 2:
+        # Most instructions are an address and one data byte, so unroll those
+        (first, second) = instruction
+        (bits, length) = _FIRST_BYTE_SIGNAL[first]
+        (signal, signal_length) = _BYTE_SIGNAL[second]
+        (last, last_length) = _LAST_BYTE_SIGNAL[first ^ second]
+        bits = (((bits << signal_length) | signal) << last_length) | last
+        length += signal_length + last_length
+    else:
+        (bits, length) = _FIRST_BYTE_SIGNAL[instruction[0]]
+        check = instruction[0]
+        for value in instruction[1:]:
+            (signal, signal_length) = _BYTE_SIGNAL[value]
+            bits = (bits << signal_length) | signal
+            length += signal_length
+            check ^= value
+        (last, last_length) = _LAST_BYTE_SIGNAL[check]
+        bits = (bits << last_length) | last
+        length += last_length
+    padding = -length & 31
+    bits = (bits << padding) | _PADDING_SIGNAL[padding]
+    return bits.to_bytes((length + padding) >> 3, "big")
+
 def decode_signal(signal):
     stream = []
     pos = 0
@@ -140,18 +283,205 @@ def decode_stream(stream):
 def decode_instruction(instruction):
     instruction = deque(instruction)
     address = instruction.popleft()
+    if 0xC0 <= address <= 0xE7:
+        # Long address
+        address = ((address & 0x3F) << 8) + instruction.popleft()
     if address == 0xFF and instruction[0] == 0:
         return (address, "IDLE", ())
     elif address == 0x00 and (instruction[0] & 0x50) == 0x50:
         return (address, "STOP", (instruction[0] & 1,))
-    elif (instruction[0] & 0xA0) == 0x20:
-        forwards = (instruction[0] & 0x40) == 0x40
+    elif (instruction[0] & 0xE0) == 0x80:
+        bits = ((instruction[0] & 0x0F) << 1) + ((instruction[0] & 0x10) >> 4)
+        return (address, "FUNCTIONS", (0, bits))
+    elif (instruction[0] & 0xE0) == 0xA0:
+        group = 1 if instruction[0] & 0x10 else 2
+        return (address, "FUNCTIONS", (group, (instruction[0] & 0x0F) << FUNCTION_GROUPS[group][0]))
+    elif instruction[0] in [0xDE, 0xDF]:
+        group = 3 if instruction[0] == 0xDE else 4
+        return (address, "FUNCTIONS", (group, instruction[1] << FUNCTION_GROUPS[group][0]))
+    elif instruction[0] == 0x3F:
+        forwards = (instruction[1] & 0x80) == 0x80
+        speed = instruction[1] & 0x7F
+        # Emergency stop decodes as -1
+        speed = speed - 1 if speed > 1 else -speed
+        return (address, "SPEED128", (forwards, speed))
+    elif (instruction[0] & 0xC0) == 0x40:
+        forwards = (instruction[0] & 0x20) == 0x20
         speed = ((instruction[0] & 0x0F) << 1) + ((instruction[0] & 0x10) >> 4)
         if speed > 0:
             speed -= 3
         return (address, "SPEED", (forwards, speed))
     assert False, "Failed to decode instruction"
 
+# A bounded, least recently used, cache of encoded packets
+# Maps instructions to DMA bytes (as to_dma_bytes), and DMA bytes back to
+# instructions (as decode_stream(decode_signal(...)))
+class PacketCache(object):
+
+    def __init__(self, maxsize=4096):
+        # Instance attributes:
+        self.maxsize = maxsize
+        self._packets = OrderedDict()
+        self._instructions = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    # Encode an instruction to DMA bytes
+    # Only misses are encoded outside the lock
+    def encode(self, instruction):
+        key = tuple(instruction)
+        with self._lock:
+            packet = self._packets.get(key)
+            if packet is not None:
+                self.hits += 1
+                self._packets.move_to_end(key)
+                return packet
+        packet = to_dma_bytes(instruction)
+        self._store(key, packet)
+        return packet
+
+    # Decode DMA bytes back to an instruction (as a tuple)
+    def decode(self, packet):
+        packet = bytes(packet)
+        with self._lock:
+            key = self._instructions.get(packet)
+            if key is not None:
+                self.hits += 1
+                self._instructions.move_to_end(packet)
+                return key
+        key = tuple(decode_stream(decode_signal(to_binary_array(list(packet)))))
+        self._store(key, packet)
+        return key
+
+    def _store(self, key, packet):
+        with self._lock:
+            self.misses += 1
+            self._packets[key] = packet
+            self._instructions[packet] = key
+            while len(self._packets) > self.maxsize:
+                self._packets.popitem(last=False)
+                self.evictions += 1
+            while len(self._instructions) > self.maxsize:
+                self._instructions.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._packets.clear()
+            self._instructions.clear()
+            self.hits = self.misses = self.evictions = 0
+
+    def stats(self):
+        return {
+            "size": len(self._packets),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+    def __len__(self):
+        return len(self._packets)
+
+    def __repr__(self):
+        return "PacketCache[size=%d,maxsize=%d]" % (len(self._packets), self.maxsize)
+
+packet_cache = PacketCache()
+
+# Bulk versions of the above, using NumPy, for whole run buffers at a time
+
+# Number of one bits in every byte value
+_POPCOUNT = numpy.unpackbits(numpy.arange(256, dtype=numpy.uint8)[:, None], axis=1).sum(axis=1).astype(numpy.int64)
+
+# Encode a list of instructions into one contiguous array of DMA bytes
+# Equivalent to b"".join(map(to_dma_bytes, instructions))
+# If out is given (eg the memory of a DmaBuffer) the bytes are written
+# straight into it, and the part of it that was written is returned
+def encode_many(instructions, out=None):
+    lengths = numpy.fromiter(map(len, instructions), dtype=numpy.int64) + 1
+    count = len(lengths)
+    if count == 0:
+        return numpy.zeros(0, dtype=numpy.uint8)
+    data = numpy.fromiter(itertools.chain.from_iterable(instructions), dtype=numpy.uint8)
+    # Interleave a checksum after each instruction
+    ends = numpy.cumsum(lengths)
+    starts = ends - lengths
+    packet_bytes = numpy.zeros(ends[-1], dtype=numpy.uint8)
+    is_check = numpy.zeros(len(packet_bytes), dtype=bool)
+    is_check[ends - 1] = True
+    packet_bytes[~is_check] = data
+    packet_bytes[ends - 1] = numpy.bitwise_xor.reduceat(data, starts - numpy.arange(count))
+    # Every packet is a preamble, 9 stream bits per byte and an end bit,
+    # padded with zero bits until its signal is a multiple of 32 bits
+    ones = 14 + numpy.add.reduceat(_POPCOUNT[packet_bytes], starts)
+    zeros = 9 * lengths - (ones - 14)
+    padding = (-(2 * ones + 4 * zeros) & 31) >> 2
+    stream_lengths = 14 + 9 * lengths + padding
+    offsets = numpy.cumsum(stream_lengths) - stream_lengths
+    stream = numpy.zeros(stream_lengths.sum(), dtype=numpy.uint8)
+    stream[offsets[:, None] + numpy.arange(13)] = 1
+    packet = numpy.repeat(numpy.arange(count), lengths)
+    byte_offsets = offsets[packet] + 13 + 9 * (numpy.arange(len(packet_bytes)) - starts[packet])
+    stream[byte_offsets[:, None] + numpy.arange(1, 9)] = numpy.unpackbits(packet_bytes[:, None], axis=1)
+    stream[offsets + 13 + 9 * lengths] = 1
+    # Each 1 becomes 10 in the signal, and each 0 becomes 1100
+    signal_lengths = 4 - 2 * stream.astype(numpy.int64)
+    signal_starts = numpy.cumsum(signal_lengths) - signal_lengths
+    signal = numpy.zeros(signal_lengths.sum(), dtype=numpy.uint8)
+    signal[signal_starts] = 1
+    signal[signal_starts[stream == 0] + 1] = 1
+    result = numpy.packbits(signal)
+    if out is None:
+        return result
+    written = numpy.frombuffer(out, dtype=numpy.uint8)[:len(result)]
+    written[:] = result
+    return written
+
+# Decode and validate a whole buffer of DMA bytes (eg as produced by
+# encode_many) back into a list of (addr, type, args) tuples
+# With ends set, returns (end, (addr, type, args)) tuples instead, where end
+# is the number of signal bits from the start of buf to the end of the packet
+def decode_many(buf, ends=False):
+    signal = numpy.unpackbits(numpy.frombuffer(buf, dtype=numpy.uint8))
+    # Find the runs of ones and zeros making up each stream bit
+    edges = numpy.flatnonzero(numpy.diff(signal.astype(numpy.int8)))
+    rises = numpy.concatenate([[0] if len(signal) and signal[0] else [], edges[signal[edges] == 0] + 1]).astype(numpy.int64)
+    falls = edges[signal[edges] == 1] + 1
+    rises = rises[:len(falls)]
+    high = falls - rises
+    low = numpy.append(rises[1:], len(signal)) - falls
+    assert numpy.all((high == 1) | (high == 2)), "Bad signal"
+    assert numpy.all(low[:-1] == high[:-1]), "Bad signal"
+    stream = (high == 1).astype(numpy.uint8)
+    if len(stream) == 0:
+        return []
+    # Packets start with the zero bit after a preamble of at least 13 ones
+    run_edges = numpy.flatnonzero(numpy.diff(stream.astype(numpy.int8))) + 1
+    run_starts = numpy.concatenate([[0], run_edges])
+    run_ends = numpy.append(run_edges, len(stream))
+    preambles = (stream[run_starts] == 1) & (run_ends - run_starts >= 13) & (run_ends < len(stream))
+    packet_starts = run_ends[preambles]
+    if len(packet_starts) == 0:
+        return []
+    # Find the end bit of each packet, ie the first bit between bytes that's a one
+    max_bytes = 8
+    separators = packet_starts[:, None] + 9 * numpy.arange(max_bytes + 1)
+    padded = numpy.append(stream, numpy.ones(9 * max_bytes + 9, dtype=numpy.uint8))
+    byte_counts = numpy.argmax(padded[separators] == 1, axis=1)
+    assert numpy.all(byte_counts >= 2), "Packet too short"
+    assert numpy.all(separators[numpy.arange(len(packet_starts)), byte_counts] < len(stream)), "Packet not terminated"
+    bits = padded[separators[:, :max_bytes, None] + numpy.arange(1, 9)]
+    values = numpy.packbits(bits, axis=2)[:, :, 0]
+    values[numpy.arange(max_bytes) >= byte_counts[:, None]] = 0
+    assert numpy.all(numpy.bitwise_xor.reduce(values, axis=1) == 0), "Bad checksum"
+    instructions = [decode_instruction(row[:n - 1].tolist()) for (row, n) in zip(values, byte_counts)]
+    if ends:
+        # The end bit of each packet is a one, ie two signal bits
+        end_bits = rises[separators[numpy.arange(len(packet_starts)), byte_counts]] + 2
+        return list(zip(end_bits.tolist(), instructions))
+    return instructions
+
 def unit_test():
     assert to_stream([1, 2]) == [1,1,1,1,1,1,1,1,1,1,1,1,1,0,0,0,0,0,0,0,0,1,0,0,0,0,0,0,0,1,0,0,0,0,0,0,0,0,1,1,1]
     assert to_binary_array(0) == [0,0,0,0,0,0,0,0]
@@ -182,7 +512,93 @@ def unit_test():
     assert decode_signal([1,0,1,0,1,1,0,0,1,0]) == [1,1,0,1]
     assert decode_stream([1,1,1,1,1,1,1,1,1,1,1,1,1,1,1,1,0,1,1,1,1,1,1,1,1,0,0,0,0,0,1,0,1,0,0,1,1,1,1,0,1,0,1,1]) == [255,10]
 
+    for instruction in [idle_instruction(), stop_instruction(True), stop_instruction(False), [1, 2], [3], [0xFF] * 5, [0xC1, 0x23, 0x3F, 0x80]]:
+        assert list(to_dma_bytes(instruction)) == to_bytes(round_up(to_signal(to_stream(instruction))))
+    for addr in range(1, 32):
+        for speed in range(0, 29):
+            for direction in [True, False]:
+                instruction = speed_instruction(addr, direction, speed)
+                assert list(to_dma_bytes(instruction)) == to_bytes(round_up(to_signal(to_stream(instruction))))
+
     for addr in range(1, 31):
         for speed in range(0, 28):
             for direction in [True, False]:
                 assert decode_instruction(decode_stream(decode_signal(to_binary_array(to_bytes(round_up(to_signal(to_stream(speed_instruction(addr, direction, speed))))))))) == (addr, "SPEED", (direction, speed))
+
+    assert speed_instruction(3, True, 1) == [3, 0x62]
+    assert speed_instruction(3, False, 28) == [3, 0x5F]
+    assert speed128_instruction(3, True, 126) == [3, 0x3F, 0xFF]
+    assert speed128_instruction(3, False, 0) == [3, 0x3F, 0x00]
+    for addr in [3, 1000]:
+        for speed in range(0, 127):
+            for direction in [True, False]:
+                decoded = decode_instruction(decode_stream(decode_signal(to_binary_array(list(to_dma_bytes(speed128_instruction(addr, direction, speed)))))))
+                assert decoded == (addr, "SPEED128", (direction, speed))
+    assert decode_instruction([3, 0x3F, 0x81]) == (3, "SPEED128", (True, -1))
+    assert speed_table(28) == list(range(29))
+    assert speed_table(128)[1] == 4 and speed_table(128)[28] == 126
+    table = speed_table(128, [10, 50, 100])
+    assert table[0] == 0 and table[1] == 13 and table[28] == 126
+    assert abs(table[14] - 63) <= 3
+    assert all(a <= b for (a, b) in zip(table, table[1:]))
+    assert speed_table(28, [0, 0, 100])[1] == 1
+    assert speed_table(28, [50]) == [0] + [14] * 28
+
+    assert function_instruction(3, 0, 0b10001) == [3, 0x98]
+    assert function_instruction(3, 1, 1 << 5) == [3, 0xB1]
+    assert function_instruction(3, 2, 1 << 12) == [3, 0xA8]
+    assert function_instruction(1000, 3, 1 << 13) == [0xC3, 0xE8, 0xDE, 1]
+    assert function_instruction(3, 4, 1 << 28) == [3, 0xDF, 0x80]
+    assert function_group(0) == 0 and function_group(8) == 1 and function_group(9) == 2 and function_group(28) == 4
+    assert sum(map(function_group_mask, range(len(FUNCTION_GROUPS)))) == (1 << (MAX_FUNCTION + 1)) - 1
+    for functions in [0, 1, 0b10110, 0x1FFFFFFF, 0x15555555]:
+        for group in range(len(FUNCTION_GROUPS)):
+            decoded = decode_instruction(decode_stream(decode_signal(to_binary_array(list(to_dma_bytes(function_instruction(200, group, functions)))))))
+            assert decoded == (200, "FUNCTIONS", (group, functions & function_group_mask(group)))
+
+    assert address_bytes(127) == [127]
+    assert address_bytes(128) == [0xC0, 0x80]
+    assert address_bytes(MAX_LONG_ADDR) == [0xE7, 0xFF]
+    for addr in [127, 128, 1000, 4000, MAX_LONG_ADDR]:
+        for speed in [0, 1, 28]:
+            instruction = speed_instruction(addr, True, speed)
+            assert decode_instruction(decode_stream(decode_signal(to_binary_array(list(to_dma_bytes(instruction)))))) == (addr, "SPEED", (True, speed))
+
+    instructions = [idle_instruction(), stop_instruction(True)] + [speed_instruction(addr, addr & 1 == 1, addr % 29) for addr in range(1, 300, 7)]
+    encoded = encode_many(instructions)
+    assert encoded.tobytes() == b"".join(map(to_dma_bytes, instructions))
+    assert decode_many(encoded) == [decode_instruction(instruction) for instruction in instructions]
+    out = bytearray(len(encoded) + 32)
+    assert len(encode_many(instructions, out)) == len(encoded)
+    assert bytes(out[:len(encoded)]) == encoded.tobytes()
+    assert decode_many(out) == decode_many(encoded)
+    assert len(encode_many([])) == 0
+    assert decode_many(bytes(64)) == []
+    offsets = numpy.cumsum([0] + [len(to_dma_bytes(instruction)) * 8 for instruction in instructions])
+    expected_ends = [offset + len(to_signal(to_stream(instruction))) for (offset, instruction) in zip(offsets, instructions)]
+    assert decode_many(encoded, ends=True) == list(zip(expected_ends, decode_many(encoded)))
+
+    cache = PacketCache(maxsize=58)
+    for speed in range(0, 29):
+        for forwards in [True, False]:
+            cache.encode(speed_instruction(3, forwards, speed))
+    assert cache.stats() == {"size": 58, "maxsize": 58, "hits": 0, "misses": 58, "evictions": 0}
+    packet = cache.encode(speed_instruction(3, True, 5))
+    assert packet == to_dma_bytes(speed_instruction(3, True, 5))
+    assert cache.hits == 1
+    assert cache.decode(packet) == tuple(speed_instruction(3, True, 5))
+    assert cache.hits == 2
+    assert cache.decode(to_dma_bytes(speed_instruction(4, True, 5))) == tuple(speed_instruction(4, True, 5))
+    assert cache.misses == 59
+    assert cache.evictions == 1
+    assert len(cache) == 58
+    # Hits made at the same time on several threads are all counted
+    cache.clear()
+    instruction = speed_instruction(3, True, 5)
+    cache.encode(instruction)
+    threads = [threading.Thread(target=lambda: [cache.encode(instruction) for i in range(2000)]) for t in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert (cache.hits, cache.misses) == (8000, 1)
@@ -0,0 +1,301 @@
+# DCC - Digital Command Control command station
+# Copyright (C) 2018 Simon Howkins
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# Source for this program is published at https://github.com/simonhowkins/dcc
+
+"""Metrics service
+
+Timing histograms and counters for the hot paths of the command station,
+rendered in the Prometheus text exposition format.
+
+Nothing is measured until enable() is called: the hot path functions are
+only wrapped with timing code then, so with metrics switched off they run
+exactly as written"""
+
+import bisect
+import functools
+import threading
+import time
+
+# Upper bounds (in seconds) of the histogram buckets, from 1us to 1s
+BUCKETS = [m * 10 ** e for e in range(-6, 0) for m in (1, 2.5, 5)] + [1.0]
+
+class Counter(object):
+
+    def __init__(self, name, description, labels=None):
+        # Instance attributes:
+        self.name = name
+        self.description = description
+        self.labels = labels or {}
+        self.value = 0
+        self._lock = threading.Lock()
+        registry.append(self)
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def samples(self):
+        yield (self.name, self.labels, self.value)
+
+    def __repr__(self):
+        return "Counter[%s%s=%s]" % (self.name, _labelText(self.labels), self.value)
+
+class Histogram(object):
+
+    def __init__(self, name, description, labels=None, buckets=BUCKETS):
+        # Instance attributes:
+        self.name = name
+        self.description = description
+        self.labels = labels or {}
+        self.buckets = list(buckets)
+        # Observations in each bucket (not cumulative), plus one for +Inf
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self._lock = threading.Lock()
+        registry.append(self)
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.sum += value
+
+    @property
+    def count(self):
+        return sum(self.counts)
+
+    def samples(self):
+        total = 0
+        for (bound, count) in zip(self.buckets + ["+Inf"], self.counts):
+            total += count
+            yield (self.name + "_bucket", dict(self.labels, le=str(bound)), total)
+        yield (self.name + "_sum", self.labels, self.sum)
+        yield (self.name + "_count", self.labels, total)
+
+    def __repr__(self):
+        return "Histogram[%s%s,count=%d]" % (self.name, _labelText(self.labels), self.count)
+
+# Time taken by requests, by controller action, and how many raised an
+# exception - whether Pyramid handled them (see tween_factory) or the ASGI
+# app ran the action itself
+class RequestMetrics(object):
+
+    def __init__(self):
+        # Instance attributes:
+        self.errors = Counter("dcc_request_errors_total", "Requests that raised an exception")
+        self.histograms = {}
+        self._lock = threading.Lock()
+
+    def observe(self, key, seconds, failed=False):
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            with self._lock:
+                histogram = self.histograms.get(key)
+                if histogram is None:
+                    histogram = self.histograms[key] = Histogram("dcc_request_seconds", "Time taken to handle each request, by controller action", {"action": key})
+        histogram.observe(seconds)
+        if failed:
+            self.errors.inc()
+
+    def __repr__(self):
+        return "RequestMetrics[actions=%d]" % len(self.histograms)
+
+# Every counter and histogram, in the order they were made
+registry = []
+# Functions that collect counters kept elsewhere, eg by the packet cache
+# Each returns a list of (name, type, description, labels, value)
+collectors = []
+
+enabled = False
+# Made by enable()
+requests = None
+# The instrumentation added by enable(), as (owner, attribute, original)
+_patches = []
+
+def _labelText(labels):
+    if not labels:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (k, str(v).replace("\\", "\\\\").replace('"', '\\"')) for (k, v) in sorted(labels.items()))
+
+def _formatValue(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+# All the metrics, in the Prometheus text format
+def render():
+    families = {}
+    for metric in registry:
+        family = families.setdefault(metric.name, ("counter" if isinstance(metric, Counter) else "histogram", metric.description, []))
+        family[2].extend(metric.samples())
+    for collect in collectors:
+        for (name, type, description, labels, value) in collect():
+            families.setdefault(name, (type, description, []))[2].append((name, labels, value))
+    lines = []
+    for (name, (type, description, samples)) in families.items():
+        lines.append("# HELP %s %s" % (name, description))
+        lines.append("# TYPE %s %s" % (name, type))
+        lines.extend("%s%s %s" % (sample, _labelText(labels), _formatValue(value)) for (sample, labels, value) in samples)
+    return "\n".join(lines) + "\n"
+
+# Time every call of a function, into histogram
+def timed(fn, histogram):
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            histogram.observe(time.perf_counter() - start)
+    return wrapper
+
+# Replace owner.attribute (a function, classmethod, staticmethod or
+# property) with a version that times every call, into a histogram of the
+# given name labelled with the call
+def instrument(owner, attribute, name, description, call):
+    original = owner.__dict__[attribute] if isinstance(owner, type) else getattr(owner, attribute)
+    if isinstance(original, property):
+        replacement = property(
+            timed(original.fget, Histogram(name, description, {"call": call + ".get"})) if original.fget else None,
+            timed(original.fset, Histogram(name, description, {"call": call + ".set"})) if original.fset else None,
+            original.fdel, original.__doc__)
+    elif isinstance(original, (classmethod, staticmethod)):
+        replacement = type(original)(timed(original.__func__, Histogram(name, description, {"call": call})))
+    else:
+        replacement = timed(original, Histogram(name, description, {"call": call}))
+    setattr(owner, attribute, replacement)
+    _patches.append((owner, attribute, original))
+
+# Switch metrics on, by instrumenting the hot paths
+def enable():
+    global enabled, requests
+    if enabled:
+        return
+    from app.services import dcclib
+    from app.models.dcc_channel import DccChannel
+
+    description = "Time taken by DCC packet encoding and decoding"
+    for fn in ["to_dma_bytes", "encode_many", "decode_many", "decode_instruction"]:
+        instrument(dcclib, fn, "dcc_codec_seconds", description, "dcclib." + fn)
+    for fn in ["encode", "decode"]:
+        instrument(dcclib.PacketCache, fn, "dcc_codec_seconds", description, "PacketCache." + fn)
+
+    description = "Time taken by DccChannel methods and properties"
+    for fn in ["peek_instruction", "poke_packet", "snapshot", "update_many", "speed", "direction", "throttle"]:
+        instrument(DccChannel, fn, "dcc_channel_seconds", description, "DccChannel." + fn)
+
+    instrument(DccChannel, "_adjustSpeeds", "dcc_ramp_tick_seconds", "Time taken by each tick of the speed ramping loop", "DccChannel._adjustSpeeds")
+    lateness = Histogram("dcc_ramp_lateness_seconds", "How late each tick of the speed ramping loop ran, compared with its deadline")
+    recordLateness = DccChannel.__dict__["_recordLateness"]
+    def _recordLateness(clazz, value):
+        lateness.observe(max(0.0, value))
+        recordLateness.__func__(clazz, value)
+    DccChannel._recordLateness = classmethod(_recordLateness)
+    _patches.append((DccChannel, "_recordLateness", recordLateness))
+
+    collectors.append(_collect)
+    requests = RequestMetrics()
+    enabled = True
+
+# Switch metrics off again, removing all the instrumentation
+def disable():
+    global enabled, requests
+    while _patches:
+        (owner, attribute, original) = _patches.pop()
+        setattr(owner, attribute, original)
+    del registry[:]
+    del collectors[:]
+    requests = None
+    enabled = False
+
+# Counters kept by the models themselves
+def _collect():
+    from app.services import dcclib
+    from app.models.dcc_channel import DccChannel
+    stats = dcclib.packet_cache.stats()
+    return [
+        ("dcc_packet_cache_hits_total", "counter", "Packet cache hits", {}, stats["hits"]),
+        ("dcc_packet_cache_misses_total", "counter", "Packet cache misses", {}, stats["misses"]),
+        ("dcc_packet_cache_evictions_total", "counter", "Packet cache evictions", {}, stats["evictions"]),
+        ("dcc_ramp_ticks_total", "counter", "Ticks of the speed ramping loop", {}, DccChannel.rampTicks),
+        ("dcc_ramping_channels", "gauge", "Channels currently ramping towards their throttle", {}, len(DccChannel._ramping)),
+        ("dcc_active_channels", "gauge", "Addresses being refreshed on the track", {}, len(DccChannel.packets._packets)),
+        ("dcc_emergency_stops_total", "counter", "Emergency stops", {}, DccChannel.stops),
+        ("dcc_emergency_stop_max_latency_seconds", "gauge", "Longest time taken for an emergency stop to reach the run buffer", {}, DccChannel.stopMaxLatency),
+    ]
+
+# Record a request that took seconds, by controller action (eg "cab.update")
+# - does nothing unless metrics are switched on
+def observe_request(key, seconds, failed=False):
+    if requests is not None:
+        requests.observe(key, seconds, failed)
+
+# Pyramid tween that times every request, by controller action
+def tween_factory(handler, pyramidRegistry):
+    def tween(request):
+        start = time.perf_counter()
+        failed = True
+        try:
+            response = handler(request)
+            failed = False
+            return response
+        finally:
+            route = request.matched_route.name if request.matched_route else "none"
+            action = request.matchdict.get("action", "") if request.matchdict else ""
+            observe_request(route + "." + action if action else route, time.perf_counter() - start, failed)
+    return tween
+
+def unit_test():
+    print("unit testing metrics")
+    from app.services import dcclib
+    from app.models.dcc_channel import DccChannel
+    original = dcclib.to_dma_bytes
+    enable()
+    try:
+        assert dcclib.to_dma_bytes is not original
+        dcclib.to_dma_bytes(dcclib.speed_instruction(3, True, 5))
+        channel = DccChannel(9)
+        channel.throttle = 0
+        assert channel.throttle == 0
+        text = render()
+        assert '# TYPE dcc_codec_seconds histogram' in text
+        assert 'dcc_codec_seconds_count{call="dcclib.to_dma_bytes"} 1' in text
+        assert 'dcc_channel_seconds_count{call="DccChannel.throttle.set"} 1' in text
+        assert 'dcc_channel_seconds_bucket{call="DccChannel.throttle.get",le="+Inf"} 1' in text
+        assert text.count("# TYPE dcc_codec_seconds") == 1
+        assert "dcc_packet_cache_hits_total" in text
+        observe_request("cab.update", 0.5)
+        observe_request("cab.update", 2, failed=True)
+        text = render()
+        assert 'dcc_request_seconds_count{action="cab.update"} 2' in text
+        assert "dcc_request_errors_total 1" in text
+    finally:
+        disable()
+    assert dcclib.to_dma_bytes is original
+    assert "_recordLateness" in DccChannel.__dict__ and isinstance(DccChannel.__dict__["throttle"], property)
+    assert render() == "\n"
+    observe_request("cab.update", 0.5)
+    assert render() == "\n"
+
+    h = Histogram("test_seconds", "Test", buckets=[0.25, 1])
+    for value in [0.125, 0.25, 0.5, 2]:
+        h.observe(value)
+    assert list(h.samples()) == [
+        ("test_seconds_bucket", {"le": "0.25"}, 2),
+        ("test_seconds_bucket", {"le": "1"}, 3),
+        ("test_seconds_bucket", {"le": "+Inf"}, 4),
+        ("test_seconds_sum", {}, 2.875),
+        ("test_seconds_count", {}, 4)]
+    registry.remove(h)
@@ -0,0 +1,315 @@
+# DCC - Digital Command Control command station
+# Copyright (C) 2018 Simon Howkins
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# Source for this program is published at https://github.com/simonhowkins/dcc
+
+"""Track simulator service
+
+Plays a refresh chain the way the DMA engine would, so the timing of the
+command station can be measured without any hardware: it streams each
+buffer for as long as its bits take on the track, then follows the buffer's
+next control block pointer, and decodes every packet it streams.
+
+It records, in track time:
+* Per-address command latency - from a command being noted (see
+  track_channels) to its packet reaching the end of the track
+* Per-address refresh rate, and the longest gap between refreshes
+* Decode errors, ie buffers that aren't a valid DCC signal
+
+Track time normally runs at real time; speedup runs it faster (or slower)
+than that, and speedup=None streams as fast as the packets can be decoded.
+The refresh chain waits for buffers to be released in real time, though,
+so command latencies are only representative at real time"""
+
+import threading
+import time
+
+from app.services import dcclib
+
+class _AddressStats(object):
+    __slots__ = ("refreshes", "firstSeen", "lastSeen", "maxGap", "latencies", "instruction")
+
+    def __init__(self, now):
+        self.refreshes = 0
+        self.firstSeen = now
+        self.lastSeen = now
+        self.maxGap = 0.0
+        self.latencies = []
+        self.instruction = None
+
+class TrackSimulator(object):
+    # Class constants:
+    # Track time spent on a zero length buffer, so an empty chain can't spin
+    EMPTY_TIME = 0.001
+
+    def __init__(self, chain, speedup=1.0):
+        # Instance attributes:
+        self.chain = chain
+        self.speedup = speedup
+        self.trackTime = 0.0
+        self.passes = 0
+        self.decodeErrors = 0
+        self.lastError = None
+        self.superseded = 0
+        self._stats = {}
+        # Commands noted but not yet seen on the track, by address:
+        # (instruction, track time noted)
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._running = False
+        self._thread = None
+        self._wallStart = None
+        self._buffer = chain.front
+
+    # Note that a command has been issued, so its latency can be measured
+    # instruction is the (addr, type, args) it will decode as
+    def note_command(self, instruction, when=None):
+        with self._lock:
+            previous = self._pending.get(instruction[0])
+            if previous is not None and previous[0] != instruction:
+                self.superseded += 1
+            if previous is None or previous[0] != instruction:
+                self._pending[instruction[0]] = (instruction, self.now() if when is None else when)
+
+    # Note every change to a DccChannel's packet, for as long as this runs
+    # Channels also change without their packet changing (eg throttle only),
+    # and a packet that's already on the track isn't a new command
+    def track_channels(self):
+        from app.models.dcc_channel import DccChannel
+        noted = {}
+        def listener(addr):
+            packet = DccChannel.packets[addr]
+            if packet is not None and noted.get(addr) != packet:
+                noted[addr] = packet
+                self.note_command(dcclib.decode_instruction(dcclib.packet_cache.decode(packet)))
+        self._listener = listener
+        DccChannel.listeners.append(listener)
+
+    # The current track time - how far the DMA engine would have got by now
+    def now(self):
+        if self.speedup is None or self._wallStart is None:
+            return self.trackTime
+        return (time.monotonic() - self._wallStart) * self.speedup
+
+    # Stream buffers for the given amount of track time, in this thread
+    def run(self, duration):
+        if self._wallStart is None:
+            self._wallStart = time.monotonic() - self.trackTime / (self.speedup or 1)
+        end = self.trackTime + duration
+        while self.trackTime < end:
+            self._pass()
+
+    # Stream buffers in a background thread, until stop()
+    def start(self):
+        self._running = True
+        self._wallStart = time.monotonic() - self.trackTime / (self.speedup or 1)
+        self._thread = threading.Thread(target=self._loop, name="track-simulator", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if getattr(self, "_listener", None):
+            from app.models.dcc_channel import DccChannel
+            DccChannel.listeners.remove(self._listener)
+            self._listener = None
+
+    def _loop(self):
+        while self._running:
+            self._pass()
+
+    # Stream one buffer, once
+    def _pass(self):
+        buffer = self._buffer
+        # The DMA engine reads the buffer as it goes - it's only ever
+        # changed while no pass is being made over it
+        frame = bytes(buffer.frame())
+        start = self.trackTime
+        duration = self.chain.frame_time(buffer) if frame else TrackSimulator.EMPTY_TIME
+        try:
+            packets = dcclib.decode_many(frame, ends=True)
+        except (AssertionError, KeyError, IndexError) as e:
+            packets = []
+            self.decodeErrors += 1
+            self.lastError = str(e) or e.__class__.__name__
+        # Wait until the track would have finished streaming the buffer
+        if self.speedup is not None:
+            time.sleep(max(0.0, self._wallStart + (start + duration) / self.speedup - time.monotonic()))
+        with self._lock:
+            for (end, instruction) in packets:
+                self._seen(instruction, start + end * self.chain.BIT_TIME)
+            self.trackTime = start + duration
+            self.passes += 1
+        # Then moves on to whichever buffer the control block points at now
+        self._buffer = self._next(buffer)
+
+    def _next(self, buffer):
+        address = buffer.header[5]
+        for candidate in self.chain.buffers:
+            if candidate.busAddress & 0xFFFFFFFF == address:
+                return candidate
+        self.decodeErrors += 1
+        self.lastError = "Next control block 0x%08x is not in the chain" % address
+        # Carry on from wherever the chain says is live, as a real DMA
+        # engine would be reset to
+        return self.chain.front
+
+    def _seen(self, instruction, when):
+        addr = instruction[0]
+        stats = self._stats.get(addr)
+        if stats is None:
+            stats = self._stats[addr] = _AddressStats(when)
+        else:
+            stats.maxGap = max(stats.maxGap, when - stats.lastSeen)
+        stats.refreshes += 1
+        stats.lastSeen = when
+        stats.instruction = instruction
+        pending = self._pending.get(addr)
+        if pending is not None and pending[0] == instruction:
+            stats.latencies.append(max(0.0, when - pending[1]))
+            del self._pending[addr]
+
+    # Everything recorded so far
+    def report(self):
+        with self._lock:
+            addresses = {}
+            for (addr, stats) in sorted(self._stats.items()):
+                span = stats.lastSeen - stats.firstSeen
+                latencies = stats.latencies
+                addresses[addr] = {
+                    "refreshes": stats.refreshes,
+                    "refreshRate": (stats.refreshes - 1) / span if span > 0 else 0.0,
+                    "maxGap": stats.maxGap,
+                    "commands": len(latencies),
+                    "meanLatency": sum(latencies) / len(latencies) if latencies else 0.0,
+                    "maxLatency": max(latencies) if latencies else 0.0,
+                }
+            return {
+                "trackTime": self.trackTime,
+                "passes": self.passes,
+                "decodeErrors": self.decodeErrors,
+                "lastError": self.lastError,
+                "superseded": self.superseded,
+                "pending": len(self._pending),
+                "addresses": addresses,
+            }
+
+    # Metrics, for app.services.metrics.collectors
+    def collect(self):
+        report = self.report()
+        samples = [
+            ("dcc_track_seconds", "counter", "Simulated track time", {}, report["trackTime"]),
+            ("dcc_track_decode_errors_total", "counter", "Simulated track buffers that failed to decode", {}, report["decodeErrors"]),
+        ]
+        for (addr, stats) in report["addresses"].items():
+            labels = {"addr": addr}
+            samples.append(("dcc_track_refresh_hz", "gauge", "Simulated track refresh rate", labels, stats["refreshRate"]))
+            samples.append(("dcc_track_max_gap_seconds", "gauge", "Longest simulated gap between refreshes", labels, stats["maxGap"]))
+            samples.append(("dcc_track_max_latency_seconds", "gauge", "Longest simulated command latency", labels, stats["maxLatency"]))
+        return samples
+
+    def __repr__(self):
+        return "TrackSimulator[trackTime=%.3f,passes=%d]" % (self.trackTime, self.passes)
+
+# Drive channels channels (addresses from firstAddr) with random throttle
+# changes, changesPerSecond of them in all, for duration seconds while
+# simulating the run buffer, and return the simulator's report
+def load_test(duration, channels=16, speedup=1.0, changesPerSecond=20, firstAddr=1):
+    import random
+    from app.models.dcc_channel import DccChannel
+    rng = random.Random(0)
+    addrs = list(range(firstAddr, firstAddr + channels))
+    simulator = TrackSimulator(DccChannel.run_buffer, speedup)
+    simulator.track_channels()
+    simulator.start()
+    try:
+        end = time.monotonic() + duration
+        while time.monotonic() < end:
+            DccChannel.update_many([(rng.choice(addrs), rng.randrange(29), None)])
+            time.sleep(1 / changesPerSecond)
+    finally:
+        DccChannel.update_many([(addr, 0, None) for addr in addrs])
+        for addr in addrs:
+            DccChannel(addr).speed = 0
+        simulator.stop()
+    return simulator.report()
+
+# Make emergency stops while channels channels (addresses from firstAddr)
+# are running, at random points in the refresh stream, and measure how long
+# each stop took to reach the track, at real time. stop is called to make
+# each stop (eg through the web app) - DccChannel.emergency_stop by default
+# Returns the simulator's report, in which address 0 (broadcast) has the
+# stop latencies
+def stop_test(trials=10, channels=16, stop=None, firstAddr=1):
+    import random
+    from app.models.dcc_channel import DccChannel
+    stop = stop or DccChannel.emergency_stop
+    rng = random.Random(0)
+    addrs = list(range(firstAddr, firstAddr + channels))
+    simulator = TrackSimulator(DccChannel.run_buffer)
+    simulator.start()
+    try:
+        for trial in range(trials):
+            DccChannel.update_many([(addr, 0, None) for addr in addrs])
+            for addr in addrs:
+                DccChannel(addr).speed = rng.randrange(1, 29)
+            # Let the stream settle, then stop at some point in a frame
+            DccChannel.run_buffer.flush(1)
+            time.sleep(rng.uniform(0.05, 0.15))
+            simulator.note_command((0, "STOP", (1,)))
+            stop()
+            # Wait for the stop to be seen on the track
+            deadline = time.monotonic() + 2 * DccChannel.packets.max_latency()
+            while 0 in simulator._pending and time.monotonic() < deadline:
+                time.sleep(0.01)
+    finally:
+        DccChannel.update_many([(addr, 0, None) for addr in addrs])
+        for addr in addrs:
+            DccChannel(addr).speed = 0
+        simulator.stop()
+    return simulator.report()
+
+def unit_test():
+    print("unit testing TrackSimulator")
+    from app.models.refresh_chain import RefreshChain
+    from app.models.packet_scheduler import PacketScheduler
+    chain = RefreshChain(512, 0)
+    scheduler = PacketScheduler(chain)
+    a = dcclib.speed_instruction(3, True, 5)
+    b = dcclib.speed_instruction(300, False, 9)
+    simulator = TrackSimulator(chain, speedup=None)
+    scheduler.update(3, dcclib.to_dma_bytes(a))
+    assert chain.flush(1)
+    simulator.run(0.5)
+    simulator.note_command(dcclib.decode_instruction(b))
+    scheduler.update(300, dcclib.to_dma_bytes(b))
+    assert chain.flush(1)
+    simulator.run(0.5)
+    report = simulator.report()
+    assert report["decodeErrors"] == 0, report["lastError"]
+    assert set(report["addresses"]) == {3, 300}
+    # A short frame is streamed many times a second
+    assert report["addresses"][3]["refreshRate"] > 20
+    assert report["addresses"][300]["commands"] == 1
+    assert 0 < report["addresses"][300]["maxLatency"] < 0.5
+    assert report["pending"] == 0
+
+    # Garbage in a buffer is a decode error
+    chain.front.view()[0:4] = b"\xff\xff\xff\xff"
+    simulator.run(0.1)
+    assert simulator.report()["decodeErrors"] > 0
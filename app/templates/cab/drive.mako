@@ -64,25 +64,55 @@
 					direction: this.value,
 				});
 			});
+			var showStatus = function(status) {
+				$("#speedo").progressbar("value", status.speed);
+				$("#speed").val(status.speed);
+				$("#throttle").slider("value", status.throttle);
+				$("input[name=direction]").filter(function() {
+					return this.value == status.direction;
+				}).closest(".btn").button("toggle");
+				$("input[name=direction]").closest(".btn").toggleClass("disabled", status.throttle !== 0 || status.speed !== 0);
+				$(".function").each(function() {
+					$(this).toggleClass("active", (status.functions & (1 << $(this).data("function"))) !== 0);
+				});
+			};
+			$("#stop").click(function() {
+				$.post({
+					url: "/cab/stop?id=${addr}",
+					success: showStatus,
+					dataType: "json",
+				});
+			});
+			$(".function").click(function() {
+				$.post({
+					url: "/cab/function?id=${addr}",
+					data: {
+						f: $(this).data("function"),
+						on: $(this).hasClass("active") ? 0 : 1,
+					},
+					success: showStatus,
+					dataType: "json",
+				});
+			});
 			var doUpdate = function(data) {
 				$.post({
 					url: "/cab/update?id=${addr}",
 					data: data,
-					success: function(status) {
-						$("#speedo").progressbar("value", status.speed);
-						$("#speed").val(status.speed);
-						$("#throttle").slider("value", status.throttle);
-						$("input[name=direction]").filter(function() {
-							return this.value == status.direction;
-						}).closest(".btn").button("toggle");
-						$("input[name=direction]").closest(".btn").toggleClass("disabled", status.throttle !== 0 || status.speed !== 0);
-					},
+					success: showStatus,
 					dataType: "json",
 				});
 			};
-			setInterval(function() {
-				doUpdate({});
-			}, 200);
+			if (window.EventSource) {
+				// The server pushes the status whenever it changes
+				var stream = new EventSource("/cab/stream?id=${addr}");
+				stream.onmessage = function(event) {
+					showStatus(JSON.parse(event.data));
+				};
+			} else {
+				setInterval(function() {
+					doUpdate({});
+				}, 200);
+			}
 		});
 	</script>
 	<style>
@@ -139,9 +169,16 @@
 		</div>
 	</div>
 </div>
+<div class="row form-group">
+	<div class="col-sm-12">
+		% for f in range(maxFunction + 1):
+		<button class="btn btn-default function" data-function="${f}">F${f}</button>
+		% endfor
+	</div>
+</div>
 <div class="row">
 	<div class="col-sm-12">
-		<button class="btn btn-danger btn-block">Emergency Stop</button>
+		<button id="stop" class="btn btn-danger btn-block">Emergency Stop</button>
 	</div>
 </div>
 
@@ -51,7 +51,7 @@
 						<div class="form-group">
 							<label class="col-sm-3 control-label">DCC Address</label>
 							<div class="col-sm-9">
-								<input type="number" class="form-control" name="addr" min="1" max="10" value="${e.addr if e.addr else ''}">
+								<input type="number" class="form-control" name="addr" min="1" max="10239" value="${e.addr if e.addr else ''}">
 							</div>
 						</div>
 						<div class="form-group">
@@ -78,6 +78,35 @@
 								</div>
 							</div>
 						</div>
+						<div class="form-group">
+							<label class="col-sm-3 control-label">Speed Steps</label>
+							<div class="col-sm-9">
+								<select class="form-control" name="speedSteps">
+% for steps in [28, 128]:
+									<option value="${steps}" ${'selected' if e.speedSteps == steps else ''}>${steps}</option>
+% endfor
+								</select>
+								<p class="help-block">The throttle always has 28 notches: 128 steps places them more precisely on the speed curve, but doesn't add more</p>
+							</div>
+						</div>
+						<div class="form-group">
+							<label class="col-sm-3 control-label">Speed Curve</label>
+							<div class="col-sm-9">
+								<div class="input-group">
+									<input type="text" class="form-control" name="speedCurve" pattern="[0-9, ]*" placeholder="Straight line" value="${', '.join(map(str, e.speedCurve or []))}">
+									<div class="input-group-addon">%</div>
+								</div>
+							</div>
+						</div>
+						<div class="form-group">
+							<label class="col-sm-3 control-label">Consist</label>
+							<div class="col-sm-6">
+								<input type="text" class="form-control" name="consist" placeholder="None" value="${e.consist}">
+							</div>
+							<div class="col-sm-3 checkbox">
+								<label><input type="checkbox" name="consistReversed" ${'checked' if e.consistReversed else ''}> Reversed</label>
+							</div>
+						</div>
 					</form>
 				</div>
 % endfor
@@ -105,7 +134,7 @@
 				<div class="form-group">
 					<label class="col-sm-3 control-label">DCC Address</label>
 					<div class="col-sm-9">
-						<input type="number" name="addr" class="form-control" min="1" max="10" value="">
+						<input type="number" name="addr" class="form-control" min="1" max="10239" value="">
 					</div>
 				</div>
 				<div class="form-group">
@@ -132,6 +161,34 @@
 						</div>
 					</div>
 				</div>
+				<div class="form-group">
+					<label class="col-sm-3 control-label">Speed Steps</label>
+					<div class="col-sm-9">
+						<select class="form-control" name="speedSteps">
+							<option value="28" selected>28</option>
+							<option value="128">128</option>
+						</select>
+						<p class="help-block">The throttle always has 28 notches: 128 steps places them more precisely on the speed curve, but doesn't add more</p>
+					</div>
+				</div>
+				<div class="form-group">
+					<label class="col-sm-3 control-label">Speed Curve</label>
+					<div class="col-sm-9">
+						<div class="input-group">
+							<input type="text" class="form-control" name="speedCurve" pattern="[0-9, ]*" placeholder="Straight line" value="">
+							<div class="input-group-addon">%</div>
+						</div>
+					</div>
+				</div>
+				<div class="form-group">
+					<label class="col-sm-3 control-label">Consist</label>
+					<div class="col-sm-6">
+						<input type="text" class="form-control" name="consist" placeholder="None" value="">
+					</div>
+					<div class="col-sm-3 checkbox">
+						<label><input type="checkbox" name="consistReversed"> Reversed</label>
+					</div>
+				</div>
 			</div>
 			<div class="modal-footer">
 				<button type="button" class="btn btn-default" data-dismiss="modal">Close</button>
@@ -0,0 +1,312 @@
+#! /usr/bin/env python
+
+# DCC - Digital Command Control command station
+# Copyright (C) 2018 Simon Howkins
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# Source for this program is published at https://github.com/simonhowkins/dcc
+
+"""Benchmarks for the hot paths of the command station
+
+Times each benchmark, and compares it with the baseline recorded in
+benchmark_baseline.json. Exits with a non-zero status if any gated benchmark
+is slower than its baseline by more than the threshold.
+
+Usage:
+    python benchmark.py [--save] [--threshold RATIO] [NAME ...]
+
+--save records the results as the new baseline. Baselines are only
+meaningful on the machine they were recorded on, so record them on the
+hardware the command station runs on.
+"""
+
+import argparse
+import json
+import os
+import os.path
+import sys
+import tempfile
+import time
+
+from app.services import dcclib
+from app.models import dcc_channel
+from app.models.dcc_channel import DccChannel
+
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark_baseline.json")
+
+# Number of channels being driven at once, for the channel benchmarks
+ACTIVE_CHANNELS = 32
+
+benchmarks = []
+
+# Register a benchmark: a function that runs the operation being measured
+# once, and (optionally) a setup function, run before each timing batch,
+# and a teardown function, run once all the batches are done
+# Benchmarks that aren't gated are reported, but never count as a regression
+def benchmark(name, number, setup=None, teardown=None, gated=True):
+    def register(fn):
+        benchmarks.append((name, fn, number, setup, teardown, gated))
+        return fn
+    return register
+
+# Run fn number times, best of repeat, and return the time per call in microseconds
+def measure(fn, number, setup=None, repeat=5):
+    best = None
+    for i in range(repeat):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        for j in range(number):
+            fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best * 1e6 / number
+
+sweep = [dcclib.speed_instruction(addr, direction, speed) for addr in range(1, 32) for speed in range(0, 28) for direction in [True, False]]
+
+@benchmark("encode_pipeline", 1)
+def encode_pipeline():
+    for instruction in sweep:
+        dcclib.to_bytes(dcclib.round_up(dcclib.to_signal(dcclib.to_stream(instruction))))
+
+@benchmark("encode_tables", 10)
+def encode_tables():
+    for instruction in sweep:
+        dcclib.to_dma_bytes(instruction)
+
+@benchmark("encode_many", 10)
+def encode_many():
+    dcclib.encode_many(sweep)
+
+encoded_sweep = dcclib.encode_many(sweep)
+
+@benchmark("decode_many", 5)
+def decode_many():
+    dcclib.decode_many(encoded_sweep)
+
+addrs = range(1, ACTIVE_CHANNELS + 1)
+
+# Drive address 3 at speed 5 (through DccChannel, so the state table and the
+# run buffer agree), so there's a real packet to poke over and peek at
+def start_channel():
+    DccChannel(3).speed = 5
+
+def stop_channel():
+    channel = DccChannel(3)
+    channel.speed = 0
+    channel.release()
+
+# Re-poke the packet the channel already has (as a cab repeating a speed would)
+@benchmark("poke_instruction", 2000, setup=start_channel, teardown=stop_channel)
+def poke_instruction():
+    DccChannel.poke_instruction(DccChannel.packets, 3, dcclib.speed_instruction(3, True, 5))
+
+@benchmark("peek_instruction", 1000, setup=start_channel, teardown=stop_channel)
+def peek_instruction():
+    assert DccChannel.peek_instruction(DccChannel.packets, 3) is not None
+
+@benchmark("channel_read", 10000, setup=start_channel, teardown=stop_channel)
+def channel_read():
+    channel = DccChannel(3)
+    (channel.speed, channel.direction, channel.throttle)
+
+# Re-encode every active channel and compose a frame from them
+@benchmark("run_buffer_rebuild", 100)
+def run_buffer_rebuild():
+    with DccChannel.lock:
+        for addr in addrs:
+            DccChannel(addr)._write(True, addr % 29)
+        DccChannel.packets.frame()
+
+rampHeld = False
+
+def start_ramping():
+    # Hold the ramping loop off, so only the benchmark ticks
+    global rampHeld
+    if not rampHeld:
+        DccChannel._rampCondition.acquire()
+        rampHeld = True
+    for addr in addrs:
+        channel = DccChannel(addr)
+        channel.speed = 0
+        channel.throttle = 28
+
+def stop_ramping():
+    for addr in addrs:
+        channel = DccChannel(addr)
+        channel.throttle = 0
+        channel.speed = 0
+    global rampHeld
+    if rampHeld:
+        DccChannel._rampCondition.release()
+        rampHeld = False
+
+# One tick of the ramping loop, with ACTIVE_CHANNELS channels accelerating
+@benchmark("ramp_tick", 28, setup=start_ramping, teardown=stop_ramping)
+def ramp_tick():
+    DccChannel._adjustSpeeds(1 / DccChannel.MAX_RAMP_RATE)
+
+# Throttle changes from 8 threads at once (500 each), while ramping runs
+@benchmark("throttle_stress", 1)
+def throttle_stress():
+    dcc_channel.stress_test(8, 500, check=False)
+
+def start_moving():
+    for addr in addrs:
+        channel = DccChannel(addr)
+        channel.throttle = 28
+        channel.speed = 20
+
+def stop_moving():
+    for addr in addrs:
+        channel = DccChannel(addr)
+        channel.throttle = 0
+        channel.speed = 0
+
+# An emergency stop, with ACTIVE_CHANNELS channels moving and ramping
+# (not counting the wait for it to reach the track)
+@benchmark("emergency_stop", 1, setup=start_moving, teardown=stop_moving)
+def emergency_stop():
+    DccChannel.emergency_stop(wait=False)
+
+cab = None
+
+def start_cab():
+    global cab
+    if cab is None:
+        import webtest
+        import app
+        databaseFile = os.path.join(tempfile.mkdtemp(), "engines.sqlite")
+        cab = webtest.TestApp(app.main({}, databaseFile=databaseFile, **{"sqlalchemy.url": "sqlite:///" + databaseFile}))
+
+@benchmark("cab_update", 200, setup=start_cab)
+def cab_update():
+    cab.post("/cab/update?id=3", {"throttle": 0})
+
+# Database load test: shed reads while another thread keeps committing
+# writes, with the default SQLite settings and with the production profile
+# Not gated - with the default settings, a read that collides with a write
+# waits for it to commit, so even with the writes paced the time varies by
+# 2x between runs
+DB_PROFILES = {
+    "default": {},
+    "production": {
+        "sqlite.journal_mode": "wal",
+        "sqlite.synchronous": "normal",
+        "sqlite.busy_timeout": "5000",
+        "sqlite.pool_size": "4",
+        "sqlite.cached_statements": "64",
+    },
+}
+
+class DbLoad(object):
+    # Engine saves per second
+    WRITE_RATE = 200
+
+    def __init__(self, profile):
+        self.profile = profile
+        self.dbEngine = None
+
+    def setup(self):
+        if self.dbEngine is not None:
+            return
+        import threading
+        import app
+        databaseFile = os.path.join(tempfile.mkdtemp(), "engines.sqlite")
+        settings = dict(DB_PROFILES[self.profile], **{"sqlalchemy.url": "sqlite:///" + databaseFile})
+        self.dbEngine = app.make_db_engine(settings)
+        app.Base.metadata.create_all(self.dbEngine)
+        with self.dbEngine.begin() as connection:
+            for addr in range(1, 21):
+                connection.execute("INSERT INTO Engine (nickname, addr, maxSpeed, acceleration, braking) VALUES (?, ?, 28, 100, 100)", "Loco %d" % addr, addr)
+        self.writing = True
+        self.writes = 0
+        self.writer = threading.Thread(target=self.write, daemon=True)
+        self.writer.start()
+
+    # Keep saving engines, as the shed does, at a steady WRITE_RATE - flat
+    # out, how often reads collide with writes varies too much between runs
+    # to compare with a baseline
+    def write(self):
+        deadline = time.monotonic()
+        while self.writing:
+            with self.dbEngine.begin() as connection:
+                connection.execute("UPDATE Engine SET maxSpeed = ? WHERE addr = ?", 1 + self.writes % 28, 1 + self.writes % 20)
+            self.writes += 1
+            deadline += 1 / DbLoad.WRITE_RATE
+            time.sleep(max(0, deadline - time.monotonic()))
+
+    def read(self):
+        with self.dbEngine.connect() as connection:
+            connection.execute("SELECT * FROM Engine").fetchall()
+
+    def teardown(self):
+        if self.dbEngine is not None:
+            self.writing = False
+            self.writer.join()
+            self.dbEngine.dispose()
+            self.dbEngine = None
+
+for profile in DB_PROFILES:
+    load = DbLoad(profile)
+    benchmark("shed_read_" + profile, 1000, setup=load.setup, teardown=load.teardown, gated=False)(load.read)
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the command station hot paths")
+    parser.add_argument("--save", action="store_true", help="record the results as the new baseline")
+    parser.add_argument("--threshold", type=float, default=1.5, help="slowdown ratio counted as a regression")
+    parser.add_argument("names", nargs="*", help="benchmarks to run (default all)")
+    args = parser.parse_args()
+
+    baseline = {}
+    if os.path.exists(BASELINE_FILE):
+        with open(BASELINE_FILE) as f:
+            baseline = json.load(f)
+
+    results = {}
+    regressions = []
+    print("%-20s %12s %12s %8s" % ("benchmark", "us/call", "baseline", "ratio"))
+    for (name, fn, number, setup, teardown, gated) in benchmarks:
+        if args.names and name not in args.names:
+            continue
+        try:
+            results[name] = measure(fn, number, setup)
+        except ImportError as e:
+            print("%-20s skipped (%s)" % (name, e))
+            continue
+        finally:
+            if teardown:
+                teardown()
+        if name in baseline:
+            ratio = results[name] / baseline[name]
+            flag = " REGRESSION" if ratio > args.threshold else ""
+            if flag and not gated:
+                flag = " (not gated)"
+            if flag and gated:
+                regressions.append(name)
+            print("%-20s %12.2f %12.2f %8.2f%s" % (name, results[name], baseline[name], ratio, flag))
+        else:
+            print("%-20s %12.2f %12s %8s" % (name, results[name], "-", "-"))
+
+    if args.save:
+        baseline.update(results)
+        with open(BASELINE_FILE, "w") as f:
+            json.dump(baseline, f, indent=4, sort_keys=True)
+            f.write("\n")
+        print("Baseline saved to %s" % BASELINE_FILE)
+    return 1 if regressions and not args.save else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -28,7 +28,11 @@ setup(
         'pyramid_tm',
         'zope.sqlalchemy',
         'pyramid_mako',
+        'numpy',
     ],
+    extras_require = {
+        'asgi': ['uvicorn'],
+    },
     entry_points="""\
         [paste.app_factory]
             main = app:main